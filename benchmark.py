@@ -0,0 +1,460 @@
+import argparse
+import gc
+import json
+import random
+import resource
+import sqlite3
+import timeit
+
+from sqlalchemy import create_engine, MetaData, select
+from sqlalchemy.sql import func
+from sqlalchemy.orm import sessionmaker
+
+import datagen
+import instrument
+import sqlite
+import sa_raw
+import sa_expressions
+import sa_orm
+import streaming
+
+
+def explain_statement(conn, statement):
+    compiled = statement.compile(dialect=conn.dialect)
+    params = [compiled.params[name] for name in compiled.positiontup]
+    cursor = conn.connection.cursor()
+    return cursor.execute(
+        'EXPLAIN QUERY PLAN ' + unicode(compiled), params).fetchall()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+class SqliteLayer(object):
+    name = 'sqlite'
+
+    def create(self, indexed=False):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.isolation_level = None
+        self.curr = self.conn.cursor()
+        self.curr.execute('begin')
+        sqlite.db_create(self.curr, indexed)
+
+    def insert(self, data):
+        return sqlite.db_load(self.curr, data)
+
+    def queries(self):
+        return sqlite.QUERIES
+
+    def rewrites(self):
+        return sqlite.REWRITES
+
+    def rewrite_baselines(self):
+        return {}
+
+    def latest_orders(self):
+        return sqlite.LATEST_ORDERS
+
+    def fetch(self, query):
+        return self.curr.execute(query).fetchall()
+
+    def execute(self, query):
+        return sum(1 for _ in self.curr.execute(query))
+
+    def explain(self, query):
+        return self.curr.execute('EXPLAIN QUERY PLAN ' + query).fetchall()
+
+    def stream(self, query, sink, batch_size):
+        return sqlite.db_stream(self.curr, query, sink, batch_size)
+
+    def close(self):
+        self.conn.rollback()
+        self.conn.close()
+
+
+class RawLayer(object):
+    name = 'sa_raw'
+
+    def create(self, indexed=False):
+        self.engine = create_engine('sqlite:///:memory:')
+        self.conn = self.engine.connect()
+        self.transaction = self.conn.begin()
+        sa_raw.db_create(self.conn, indexed)
+
+    def insert(self, data):
+        return sa_raw.db_load(self.conn, data)
+
+    def queries(self):
+        return sa_raw.QUERIES
+
+    def rewrites(self):
+        return sa_raw.REWRITES
+
+    def rewrite_baselines(self):
+        return {}
+
+    def latest_orders(self):
+        return sa_raw.LATEST_ORDERS
+
+    def fetch(self, query):
+        return self.conn.execute(query).fetchall()
+
+    def execute(self, query):
+        return sum(1 for _ in self.conn.execute(query))
+
+    def explain(self, query):
+        return self.conn.execute('EXPLAIN QUERY PLAN ' + query).fetchall()
+
+    def stream(self, query, sink, batch_size):
+        return sa_raw.db_stream(self.conn, query, sink, batch_size)
+
+    def close(self):
+        self.transaction.rollback()
+        self.conn.close()
+
+
+class ExpressionsLayer(RawLayer):
+    name = 'sa_expressions'
+
+    def create(self, indexed=False):
+        self.engine = create_engine('sqlite:///:memory:')
+        self.conn = self.engine.connect()
+        self.metadata = MetaData()
+        self.transaction = self.conn.begin()
+        self.tables = sa_expressions.db_create(
+            self.conn, self.metadata, indexed)
+        self.metadata.create_all(self.conn)
+
+    def insert(self, data):
+        return sa_expressions.db_load(self.conn, self.tables, data)
+
+    def queries(self):
+        return sa_expressions.db_queries(self.tables)
+
+    def rewrites(self):
+        return sa_expressions.db_rewrites(self.tables)
+
+    def rewrite_baselines(self):
+        return {}
+
+    def latest_orders(self):
+        return sa_expressions.db_latest_orders(self.tables)
+
+    def explain(self, query):
+        return explain_statement(self.conn, query)
+
+    def stream(self, query, sink, batch_size):
+        return sa_expressions.db_stream(self.conn, query, sink, batch_size)
+
+
+class OrmLayer(object):
+    name = 'sa_orm'
+
+    def create(self, indexed=False):
+        self.engine = create_engine('sqlite:///:memory:')
+        self.session = sessionmaker(bind=self.engine)()
+        sa_orm.db_create(self.engine, indexed)
+
+    def insert(self, data):
+        return sa_orm.db_load(self.session, data)
+
+    def queries(self):
+        return sa_orm.db_queries(self.session)
+
+    def rewrites(self):
+        return sa_orm.db_rewrites(self.session)
+
+    def rewrite_baselines(self):
+        return sa_orm.db_rewrite_baselines(self.session)
+
+    def latest_orders(self):
+        return sa_orm.db_latest_orders(self.session)
+
+    def fetch(self, query):
+        return query.all()
+
+    def execute(self, query):
+        return sum(1 for _ in query)
+
+    def explain(self, query):
+        return explain_statement(self.session.connection(), query.statement)
+
+    def stream(self, query, sink, batch_size):
+        return sa_orm.db_stream(query, sink, batch_size)
+
+    def close(self):
+        self.session.rollback()
+        self.session.close()
+
+
+class OrmBulkLayer(OrmLayer):
+    name = 'sa_orm_bulk'
+
+    def insert(self, data):
+        return sa_orm.db_bulk_load(self.session, data)
+
+
+class OrmMappingsLayer(OrmLayer):
+    name = 'sa_orm_mappings'
+
+    def insert(self, data):
+        return sa_orm.db_bulk_load(self.session, data, core=False)
+
+
+class OrmRowsLayer(OrmBulkLayer):
+    name = 'sa_orm_rows'
+
+    def fetch(self, query):
+        return list(sa_orm.db_rows(query))
+
+    def execute(self, query):
+        return sum(1 for _ in sa_orm.db_rows(query))
+
+    def stream(self, query, sink, batch_size):
+        return streaming.stream(
+            datagen.chunks(sa_orm.db_rows(query), batch_size), sink)
+
+
+LAYERS = [SqliteLayer, RawLayer, ExpressionsLayer, OrmLayer,
+          OrmBulkLayer, OrmMappingsLayer, OrmRowsLayer]
+
+
+def run_layer(layer, data, repeat, indexed=False, instrumentation=None):
+    start = timeit.default_timer()
+
+    layer.create(indexed)
+    if instrumentation is not None and hasattr(layer, 'engine'):
+        instrumentation.attach(layer.engine)
+    created = timeit.default_timer()
+
+    loaded = layer.insert(data)
+    inserted = timeit.default_timer()
+
+    results = []
+    for number, query in enumerate(layer.queries(), 1):
+        timings = []
+        for _ in xrange(repeat):
+            begin = timeit.default_timer()
+            rows = layer.execute(query)
+            timings.append(timeit.default_timer() - begin)
+        results.append((number, rows, timings))
+
+    layer.close()
+    finished = timeit.default_timer()
+
+    return {
+        'create': created - start,
+        'insert': inserted - created,
+        'loaded': loaded,
+        'queries': results,
+        'total': finished - start
+    }
+
+
+def resident_size():
+    # the current resident size in kB. ru_maxrss only ever grows and is
+    # already at the high-water mark of the load.
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() // 1024
+
+
+def run_export(layer, data, batch_size, indexed=False):
+    layer.create(indexed)
+    layer.insert(data)
+
+    # 2. get all orders. The resident size is sampled once per batch
+    # and the peak is taken over the samples.
+    query = layer.queries()[1]
+    gc.collect()
+    rss_before = resident_size()
+    samples = {'records': 0, 'peak': rss_before}
+
+    def sink(record):
+        samples['records'] += 1
+        if samples['records'] % batch_size == 0:
+            samples['peak'] = max(samples['peak'], resident_size())
+
+    report = layer.stream(query, sink, batch_size)
+    report['rss_growth'] = max(samples['peak'], resident_size()) - rss_before
+
+    layer.close()
+    return report
+
+
+def print_export_report(name, report):
+    print '%s: export %d rows, first row %.3fms, total %.3fs ' \
+          '(%d rows/s), peak rss growth %d kB' % (
+              name, report['rows'], (report['first_row'] or 0) * 1000,
+              report['total'], report['rows'] / max(report['total'], 1e-9),
+              report['rss_growth'])
+
+
+def run_loading(data, customer_id, indexed=False):
+    layer = OrmLayer()
+    layer.create(indexed)
+    layer.insert(data)
+    layer.session.commit()
+
+    results = []
+    for strategy in sorted(sa_orm.LOADERS):
+        if strategy == 'raise':
+            continue
+        layer.session.expunge_all()
+
+        begin = timeit.default_timer()
+        with instrument.count_statements(layer.engine) as counter:
+            products = sa_orm.db_customer_products(
+                layer.session, customer_id, strategy)
+        results.append((strategy, len(products), counter['statements'],
+                        timeit.default_timer() - begin))
+
+    layer.close()
+    return results
+
+
+def print_loading_report(customer_id, results):
+    print 'customer %d order graph:' % customer_id
+    print '  %10s %10s %12s %10s' % ('strategy', 'products', 'statements', 'ms')
+    for strategy, products, statements, elapsed in results:
+        print '  %10s %10d %12d %10.3f' % (
+            strategy, products, statements, elapsed * 1000)
+    print
+
+
+def run_lookups(data, n_customers, lookups, indexed=False):
+    layer = ExpressionsLayer()
+    layer.create(indexed)
+    layer.insert(data)
+
+    orders = layer.tables['orders']
+    products = layer.tables['products']
+    order_product = layer.tables['order_product']
+
+    rnd = random.Random(0)
+    customer_ids = [rnd.randint(1, n_customers) for _ in xrange(lookups)]
+
+    # 4. and 8. built with an inlined customer id, as db_select does.
+    begin = timeit.default_timer()
+    for customer_id in customer_ids:
+        layer.conn.execute(
+            select([orders]).where(orders.c.customer_id == customer_id)).\
+            fetchall()
+        order_ids = select([orders.c.id]).\
+            where(orders.c.customer_id == customer_id)
+        product_ids = select([order_product.c.product_id]).\
+            where(order_product.c.order_id.in_(order_ids))
+        layer.conn.execute(
+            select([func.sum(products.c.price)]).\
+            where(products.c.id.in_(product_ids))).fetchall()
+    rebuilt = timeit.default_timer() - begin
+
+    begin = timeit.default_timer()
+    catalog = sa_expressions.QueryCatalog(layer.tables, layer.conn.dialect)
+    for customer_id in customer_ids:
+        catalog.execute(layer.conn, 4, customer_id=customer_id).fetchall()
+        catalog.execute(layer.conn, 8, customer_id=customer_id).fetchall()
+    precompiled = timeit.default_timer() - begin
+
+    layer.close()
+    return rebuilt, precompiled
+
+
+def print_lookups_report(lookups, rebuilt, precompiled):
+    print '%d customer lookups (queries 4 and 8):' % lookups
+    print '  rebuilt:     %.3fs (%d lookups/s)' % (
+        rebuilt, lookups / max(rebuilt, 1e-9))
+    print '  precompiled: %.3fs (%d lookups/s)' % (
+        precompiled, lookups / max(precompiled, 1e-9))
+    print
+
+
+def print_report(name, report):
+    print '%s: create %.3fs, insert %.3fs (%d rows/s), total %.3fs' % (
+        name, report['create'], report['insert'],
+        report['loaded'] / max(report['insert'], 1e-9), report['total'])
+    print '  %5s %10s %10s %10s %10s %12s' % (
+        'query', 'rows', 'p50 ms', 'p95 ms', 'p99 ms', 'rows/s')
+
+    for number, rows, timings in report['queries']:
+        p50 = percentile(timings, 50)
+        print '  %5d %10d %10.3f %10.3f %10.3f %12d' % (
+            number, rows, p50 * 1000,
+            percentile(timings, 95) * 1000,
+            percentile(timings, 99) * 1000,
+            rows / max(p50, 1e-9))
+    print
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run the reference queries through every layer.')
+    parser.add_argument('--orders', type=int, nargs='+', default=[1000],
+                        help='data sizes as numbers of orders')
+    parser.add_argument('--layers', nargs='+',
+                        default=[layer.name for layer in LAYERS],
+                        choices=[layer.name for layer in LAYERS])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--indexed', action='store_true',
+                        help='create primary keys and indexes')
+    parser.add_argument('--export', action='store_true',
+                        help='only stream all orders through a null sink')
+    parser.add_argument('--batch-size', type=int,
+                        default=streaming.BATCH_SIZE)
+    parser.add_argument('--instrument', metavar='PATH',
+                        help='dump per-statement timings of the '
+                             'SQLAlchemy layers as JSON')
+    parser.add_argument('--lookups', type=int, metavar='N',
+                        help='compare rebuilt and precompiled Core '
+                             'statements on N customer lookups')
+    parser.add_argument('--loading', type=int, metavar='CUSTOMER_ID',
+                        help='compare ORM loading strategies on the '
+                             'order graph of one customer')
+    args = parser.parse_args()
+
+    timings = {}
+    for n_orders in args.orders:
+        print '=== %d orders' % n_orders
+        print
+
+        if args.lookups is not None:
+            data = datagen.generate(n_orders, args.seed)
+            n_customers, _ = datagen.sizes(n_orders)
+            print_lookups_report(
+                args.lookups,
+                *run_lookups(data, n_customers, args.lookups, args.indexed))
+            continue
+
+        if args.loading is not None:
+            data = datagen.generate(n_orders, args.seed)
+            print_loading_report(
+                args.loading,
+                run_loading(data, args.loading, args.indexed))
+            continue
+
+        for layer in LAYERS:
+            if layer.name in args.layers:
+                data = datagen.generate(n_orders, args.seed)
+                if args.export:
+                    report = run_export(
+                        layer(), data, args.batch_size, args.indexed)
+                    print_export_report(layer.name, report)
+                else:
+                    instrumentation = None
+                    if args.instrument:
+                        instrumentation = instrument.Instrumentation()
+                    report = run_layer(layer(), data, args.repeat,
+                                       args.indexed, instrumentation)
+                    print_report(layer.name, report)
+
+                    if instrumentation is not None:
+                        timings.setdefault(n_orders, {})[layer.name] = \
+                            instrumentation.as_dict()
+
+    if args.instrument:
+        with open(args.instrument, 'w') as f:
+            json.dump(timings, f, indent=2, sort_keys=True)
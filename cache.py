@@ -0,0 +1,353 @@
+import argparse
+import collections
+import operator
+import re
+import sys
+import threading
+import time
+import timeit
+import weakref
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import RowProxy
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.util import find_tables
+
+import datagen
+import instrument
+import sa_orm
+
+
+WRITE = re.compile(
+    r'^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|UPDATE(?:\s+OR\s+\w+)?|'
+    r'DELETE\s+FROM|REPLACE\s+INTO)\s+["`]?(\w+)', re.IGNORECASE)
+
+
+def estimate_size(value):
+    if isinstance(value, (tuple, list, RowProxy)):
+        return sys.getsizeof(value) + sum(estimate_size(item)
+                                          for item in value)
+    if hasattr(value, '__dict__'):
+        # mapped instances, _sa_instance_state is left out.
+        return sys.getsizeof(value) + sum(
+            sys.getsizeof(item) for key, item in vars(value).items()
+            if not key.startswith('_sa_'))
+    return sys.getsizeof(value)
+
+
+# a cached row as the ORM reads it, by the columns of the statement
+# being loaded.
+class CachedRow(object):
+    __slots__ = ('positions', 'values')
+
+    def __init__(self, positions, values):
+        self.positions = positions
+        self.values = values
+
+    def __getitem__(self, column):
+        return self.values[self.positions[column]]
+
+
+# the rows of a result read again by query.instances(), as if they came
+# from the database. The columns of the statement are looked up by their
+# position in the compiled SQL, so the rows cached for one query serve
+# every query that compiles to the same SQL.
+class CachedResult(object):
+    def __init__(self, compiled, rows):
+        self.positions = {}
+        for position, (keyname, name, objects, type_) in enumerate(
+                compiled._result_columns):
+            for column in objects:
+                self.positions.setdefault(column, position)
+        self.rows = rows
+        self.position = 0
+
+    def _getter(self, column, raiseerr=True):
+        if column in self.positions:
+            get = operator.itemgetter(self.positions[column])
+            return lambda row: get(row.values)
+        if raiseerr:
+            raise exc.NoSuchColumnError(
+                'Could not locate column in row for column %r' % column)
+        return None
+
+    def _has_key(self, column):
+        return column in self.positions
+
+    def fetchmany(self, size):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return [CachedRow(self.positions, values) for values in rows]
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+    def close(self):
+        pass
+
+
+# LRU cache of query results, keyed by the compiled SQL and its
+# parameters. Entries are dropped when they are older than ttl seconds,
+# when the estimated size of all entries goes over max_bytes, and
+# whenever a statement on an attached engine writes to one of their
+# tables. Every write also moves the generation of its table on, a
+# result read while the generation moved is not cached.
+class ResultCache(object):
+    def __init__(self, max_bytes=64 << 20, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.keys_by_table = collections.defaultdict(set)
+        self.generations = collections.Counter()
+        self.lock = threading.RLock()
+        self.compiled = weakref.WeakKeyDictionary()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def attach(self, engine):
+        event.listen(engine, 'after_cursor_execute', self.after_write)
+        event.listen(engine, 'commit', self.after_commit)
+        event.listen(engine, 'rollback', self.after_rollback)
+        return self
+
+    def detach(self, engine):
+        event.remove(engine, 'after_cursor_execute', self.after_write)
+        event.remove(engine, 'commit', self.after_commit)
+        event.remove(engine, 'rollback', self.after_rollback)
+
+    def after_write(self, conn, cursor, statement, parameters, context,
+                    executemany):
+        match = WRITE.match(statement)
+        if match:
+            table = match.group(1).lower()
+            conn.info.setdefault('cache_written', set()).add(table)
+            self.invalidate(table)
+
+    def after_commit(self, conn):
+        # other connections only see the write now, what they cached
+        # between the write and the commit is stale as well.
+        for table in conn.info.pop('cache_written', ()):
+            self.invalidate(table)
+
+    def after_rollback(self, conn):
+        conn.info.pop('cache_written', None)
+
+    def invalidate(self, table):
+        table = table.lower()
+        with self.lock:
+            self.generations[table] += 1
+            for key in self.keys_by_table.pop(table, ()):
+                if key in self.entries:
+                    self.remove(key)
+                    self.invalidations += 1
+
+    def generation(self, tables):
+        # read before the query, handed to put() after it.
+        with self.lock:
+            return tuple(self.generations[table] for table in sorted(tables))
+
+    def remove(self, key):
+        rows, tables, size, expires = self.entries.pop(key)
+        self.size -= size
+        for table in tables:
+            self.keys_by_table[table].discard(key)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[3] is not None and \
+                    entry[3] < time.time():
+                self.remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            # most recently used entries go to the end.
+            del self.entries[key]
+            self.entries[key] = entry
+            return entry[0]
+
+    def put(self, key, rows, tables, generation=None):
+        size = estimate_size(rows)
+        if size > self.max_bytes:
+            return
+
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            if generation is not None and \
+                    generation != self.generation(tables):
+                # a table was written while the rows were read.
+                return
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (rows, tables, size, expires)
+            self.size += size
+            for table in tables:
+                self.keys_by_table[table].add(key)
+
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def compile(self, statement, dialect):
+        # statements are usually built once and run many times, so their
+        # compiled form and tables are kept next to them.
+        compiled = self.compiled.get(statement)
+        if compiled is None or compiled[0].dialect is not dialect:
+            tables = frozenset(
+                table.name.lower()
+                for table in find_tables(statement, include_aliases=True))
+            compiled = (statement.compile(dialect=dialect), tables)
+            self.compiled[statement] = compiled
+        return compiled
+
+    def key(self, compiled, params):
+        values = compiled.construct_params(params)
+        return unicode(compiled), tuple(sorted(values.items()))
+
+    def execute(self, conn, statement, **params):
+        # Core path: returns the result rows as a list.
+        compiled, tables = self.compile(statement, conn.dialect)
+        key = self.key(compiled, params)
+        rows = self.get(key)
+        if rows is None:
+            generation = self.generation(tables)
+            rows = conn.execute(compiled, params).fetchall()
+            self.put(key, rows, tables, generation)
+        return rows
+
+    def query(self, query):
+        # ORM path: the database rows are cached, not the instances,
+        # which expire when the session that loaded them commits. A hit
+        # builds the instances from the cached rows in the session of
+        # the query, the way the query itself would. Eager loads that
+        # run statements of their own, selectin and subquery, still do.
+
+        # the statement with the eager loads of the query, it is built
+        # again by every query so the compiled form isn't kept.
+        context = query._compile_context()
+        statement = context.statement
+        if query.session.autoflush:
+            query.session.flush()
+        # the connection the query runs on, sessions that route or shard
+        # have no single session.bind.
+        conn = query.session.connection(query._bind_mapper(),
+                                        clause=statement)
+        compiled = statement.compile(dialect=conn.dialect)
+        tables = frozenset(
+            table.name.lower()
+            for table in find_tables(statement, include_aliases=True))
+
+        key = self.key(compiled, {})
+        rows = self.get(key)
+        if rows is None:
+            generation = self.generation(tables)
+            rows = [tuple(row) for row in conn.execute(compiled)]
+            self.put(key, rows, tables, generation)
+        return list(query.instances(CachedResult(compiled, rows), context))
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / requests if requests else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'entries': len(self.entries),
+            'bytes': self.size
+        }
+
+
+def add_customer(layer, i):
+    values = {'name': 'new%d' % i, 'surname': 'new',
+              'email': 'new%d@email.com' % i}
+    if layer.name == 'sa_orm':
+        layer.session.add(sa_orm.Customer(**values))
+        layer.session.flush()
+    else:
+        layer.conn.execute(layer.tables['customers'].insert(), values)
+
+
+def run(layer, rounds, write_every, cache=None):
+    queries = layer.queries()
+    begin = timeit.default_timer()
+    for i in xrange(rounds):
+        for query in queries:
+            if cache is None:
+                layer.fetch(query)
+            elif layer.name == 'sa_orm':
+                cache.query(query)
+            else:
+                cache.execute(layer.conn, query)
+
+        if write_every and i % write_every == write_every - 1:
+            add_customer(layer, i)
+    return timeit.default_timer() - begin
+
+
+def check_hit_after_commit():
+    # a hit in a new session, after the session that loaded the rows
+    # has committed, sends no statements and prints the same rows.
+    engine = create_engine('sqlite://')
+    sa_orm.db_create(engine)
+    Session = sessionmaker(bind=engine)
+    cache = ResultCache().attach(engine)
+
+    session = Session()
+    sa_orm.db_insert(session)
+    session.commit()
+    loaded = [repr(cache.query(query))
+              for query in sa_orm.db_queries(session)]
+    session.commit()
+    session.close()
+
+    session = Session()
+    queries = sa_orm.db_queries(session)
+    with instrument.count_statements(engine) as counter:
+        hits = [repr(cache.query(query)) for query in queries]
+    assert counter['statements'] == 0 and hits == loaded
+    assert cache.stats()['hits'] == len(queries)
+    session.close()
+
+
+if __name__ == '__main__':
+    from benchmark import ExpressionsLayer, OrmLayer
+
+    check_hit_after_commit()
+
+    parser = argparse.ArgumentParser(
+        description='Run the report queries with and without the cache.')
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--write-every', type=int, default=10,
+                        help='insert a customer every N rounds')
+    parser.add_argument('--max-mb', type=int, default=64)
+    parser.add_argument('--ttl', type=float)
+    args = parser.parse_args()
+
+    for layer_class in (ExpressionsLayer, OrmLayer):
+        results = []
+        for cached in (False, True):
+            layer = layer_class()
+            layer.create(indexed=True)
+            layer.insert(datagen.generate(args.orders))
+
+            cache = None
+            if cached:
+                cache = ResultCache(args.max_mb << 20, args.ttl).attach(
+                    layer.engine)
+            results.append(run(layer, args.rounds, args.write_every, cache))
+            layer.close()
+
+        print '%s: uncached %.3fs, cached %.3fs' % (
+            layer_class.name, results[0], results[1])
+        print '  %s' % ', '.join('%s %s' % item
+                                 for item in sorted(cache.stats().items()))
@@ -0,0 +1,151 @@
+import argparse
+import collections
+import sqlite3
+import timeit
+
+import numpy
+
+import datagen
+
+
+EXPORT_SIZE = 65536
+
+# column types of the tables for the raw sqlite3 export, in table order.
+ORDERS = [('id', 'int64'), ('customer_id', 'int64'),
+          ('init_time', 'datetime64[us]')]
+PRODUCTS = [('id', 'int64'), ('name', 'object'), ('price', 'int64')]
+ORDER_PRODUCT = [('order_id', 'int64'), ('product_id', 'int64')]
+
+
+def fetch_columns(cursor, columns, batch_size=EXPORT_SIZE,
+                  epoch_columns=()):
+    # the rows of an executed DBAPI cursor as one array per column. Every
+    # batch goes into a record array in one call and is copied a column
+    # at a time into arrays that grow twice as large when they fill up.
+    # SQLite hands out datetimes as ISO strings, numpy parses them while
+    # copying. The datetimes of epoch_columns are integer microseconds,
+    # which are datetime64[us] as they are.
+    def stored(name, dtype):
+        if name in epoch_columns:
+            return 'int64'
+        return 'S26' if dtype.startswith('datetime64') else dtype
+
+    record = numpy.dtype([(name, stored(name, dtype))
+                          for name, dtype in columns])
+
+    arrays = collections.OrderedDict(
+        (name, numpy.empty(batch_size, dtype)) for name, dtype in columns)
+    size = 0
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+
+        batch = numpy.array(batch, dtype=record)
+        if size + len(batch) > len(arrays.values()[0]):
+            for name, array in arrays.items():
+                grown = numpy.empty(2 * len(array), array.dtype)
+                grown[:size] = array[:size]
+                arrays[name] = grown
+
+        for name, array in arrays.items():
+            array[size:size + len(batch)] = batch[name]
+        size += len(batch)
+
+    return collections.OrderedDict(
+        (name, array[:size]) for name, array in arrays.items())
+
+
+def revenue_per_product(order_product, products):
+    # products ids are dense, so the price of a product id is an index
+    # away.
+    prices = numpy.zeros(products['id'].max() + 1, 'int64')
+    prices[products['id']] = products['price']
+    revenue = numpy.bincount(order_product['product_id'],
+                             weights=prices[order_product['product_id']],
+                             minlength=len(prices)).astype('int64')
+    return revenue[products['id']]
+
+
+def orders_per_day(orders):
+    days, counts = numpy.unique(orders['init_time'].astype('datetime64[D]'),
+                                return_counts=True)
+    return days, counts
+
+
+def python_revenue_per_product(order_product, products):
+    prices = dict((row[0], row[2]) for row in products)
+    revenue = dict((row[0], 0) for row in products)
+    for order_id, product_id in order_product:
+        revenue[product_id] += prices[product_id]
+    return [revenue[row[0]] for row in products]
+
+
+def python_orders_per_day(orders):
+    counts = collections.Counter(row[2][:10] for row in orders)
+    return sorted(counts.items())
+
+
+if __name__ == '__main__':
+    import sqlite
+    import sa_expressions
+    from benchmark import ExpressionsLayer
+
+    parser = argparse.ArgumentParser(
+        description='Aggregate revenue per product and orders per day '
+                    'in Python loops and on numpy columns.')
+    parser.add_argument('--orders', type=int, default=1000000)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(':memory:')
+    curr = conn.cursor()
+    sqlite.db_create(curr, indexed=True)
+    sqlite.db_load(curr, datagen.generate(args.orders))
+
+    begin = timeit.default_timer()
+    orders = curr.execute('SELECT * FROM orders').fetchall()
+    products = curr.execute('SELECT * FROM products').fetchall()
+    order_product = curr.execute('SELECT * FROM order_product').fetchall()
+    fetched = timeit.default_timer() - begin
+
+    begin = timeit.default_timer()
+    revenue = python_revenue_per_product(order_product, products)
+    per_day = python_orders_per_day(orders)
+    aggregated = timeit.default_timer() - begin
+    print 'sqlite tuples:  fetch %.3fs, aggregate %.3fs' % (fetched, aggregated)
+
+    begin = timeit.default_timer()
+    orders = sqlite.db_export(curr, 'SELECT * FROM orders', ORDERS)
+    products = sqlite.db_export(curr, 'SELECT * FROM products', PRODUCTS)
+    order_product = sqlite.db_export(
+        curr, 'SELECT * FROM order_product', ORDER_PRODUCT)
+    fetched = timeit.default_timer() - begin
+
+    begin = timeit.default_timer()
+    columns_revenue = revenue_per_product(order_product, products)
+    days, counts = orders_per_day(orders)
+    aggregated = timeit.default_timer() - begin
+    print 'sqlite columns: fetch %.3fs, aggregate %.3fs' % (fetched, aggregated)
+
+    assert columns_revenue.tolist() == revenue
+    assert [count for _, count in per_day] == counts.tolist()
+    conn.close()
+
+    # the same orders through the Core layer.
+    layer = ExpressionsLayer()
+    layer.create(indexed=True)
+    layer.insert(datagen.generate(args.orders))
+    select_orders = layer.queries()[1]
+
+    begin = timeit.default_timer()
+    layer.conn.execute(select_orders).fetchall()
+    fetched = timeit.default_timer() - begin
+    print 'core rows:    fetch orders %.3fs' % fetched
+
+    begin = timeit.default_timer()
+    core_orders = sa_expressions.db_export(layer.conn, select_orders)
+    fetched = timeit.default_timer() - begin
+    print 'core columns: fetch orders %.3fs' % fetched
+
+    assert (core_orders['init_time'] == orders['init_time']).all()
+    layer.close()
@@ -0,0 +1,253 @@
+import argparse
+import csv
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import timeit
+
+from sqlalchemy import create_engine, MetaData
+from sqlalchemy.schema import CreateTable
+
+import datagen
+import sa_expressions
+import sa_orm
+import sqlite
+from profiles import apply_profile, use_profile
+
+
+# parents before children, so foreign keys always point to loaded rows.
+TABLES = ['customers', 'products', 'orders', 'order_product']
+
+
+def parse_datetime(text):
+    # the fixed 'YYYY-MM-DD HH:MM:SS[.ffffff]' layout of str(datetime),
+    # several times faster than strptime.
+    return datetime.datetime(
+        int(text[0:4]), int(text[5:7]), int(text[8:10]),
+        int(text[11:13]), int(text[14:16]), int(text[17:19]),
+        int(text[20:26].ljust(6, '0')))
+
+
+def decode(text):
+    # csv reads bytes, sqlite3 only takes text as unicode.
+    return text.decode('utf-8')
+
+
+CONVERTERS = {
+    'customers': [int, decode, decode, decode],
+    'products': [int, decode, int],
+    'orders': [int, int, parse_datetime],
+    'order_product': [int, int]
+}
+
+
+def write_csv(directory, data):
+    for name in TABLES:
+        with open(os.path.join(directory, name + '.csv'), 'wb') as f:
+            csv.writer(f).writerows(
+                [value.encode('utf-8') if isinstance(value, unicode)
+                 else value for value in row]
+                for row in data[name])
+
+
+def read_csv(directory, name, chunk_size=datagen.CHUNK_SIZE):
+    with open(os.path.join(directory, name + '.csv'), 'rb') as f:
+        for chunk in datagen.chunks(csv.reader(f), chunk_size):
+            yield chunk
+
+
+def convert(chunk, converters):
+    # a column at a time, a single map per column instead of a call per
+    # value and row. None keeps the column as it is.
+    columns = [map(converter, column) if converter is not None else column
+               for converter, column in zip(converters, zip(*chunk))]
+    return zip(*columns)
+
+
+def load_sqlite(path, directory, chunk_size=datagen.CHUNK_SIZE,
+                deferred=True):
+    conn = sqlite3.connect(path)
+    conn.isolation_level = None
+    curr = conn.cursor()
+    apply_profile(curr, 'bulk-load')
+    sqlite.db_create(curr, indexed=not deferred)
+
+    report = []
+    for name in TABLES:
+        begin = timeit.default_timer()
+        rows = 0
+        # the columns have numeric affinity, SQLite converts the numbers
+        # itself and keeps the datetimes as text, the same text sqlite3
+        # stores for a datetime. Only the text columns are decoded.
+        converters = [converter if converter is decode else None
+                      for converter in CONVERTERS[name]]
+        text = 'INSERT INTO %s VALUES (%s)' % (
+            name, ', '.join('?' * len(converters)))
+        for chunk in read_csv(directory, name, chunk_size):
+            if decode in converters:
+                chunk = convert(chunk, converters)
+            curr.execute('begin')
+            curr.executemany(text, chunk)
+            curr.execute('commit')
+            rows += len(chunk)
+        report.append((name, rows, timeit.default_timer() - begin))
+
+    begin = timeit.default_timer()
+    if deferred:
+        curr.execute('begin')
+        sqlite.db_index(curr)
+        curr.execute('commit')
+    report.append(('indexes', 0, timeit.default_timer() - begin))
+
+    conn.close()
+    return report
+
+
+def create_tables(engine, tables):
+    # CREATE TABLE without the indexes of the tables.
+    with engine.begin() as conn:
+        for name in TABLES:
+            conn.execute(CreateTable(tables[name]))
+
+
+def create_indexes(engine, tables):
+    with engine.begin() as conn:
+        for name in TABLES:
+            for index in tables[name].indexes:
+                index.create(conn)
+
+
+def load_tables(engine, tables, directory, chunk_size=datagen.CHUNK_SIZE):
+    report = []
+    for name in TABLES:
+        begin = timeit.default_timer()
+        rows = 0
+        keys = tables[name].c.keys()
+        insert = tables[name].insert()
+        for chunk in read_csv(directory, name, chunk_size):
+            with engine.begin() as conn:
+                conn.execute(insert, [
+                    dict(zip(keys, row))
+                    for row in convert(chunk, CONVERTERS[name])])
+            rows += len(chunk)
+        report.append((name, rows, timeit.default_timer() - begin))
+    return report
+
+
+def load_expressions(path, directory, chunk_size=datagen.CHUNK_SIZE,
+                     deferred=True):
+    engine = use_profile(create_engine('sqlite:///' + path), 'bulk-load')
+    metadata = MetaData()
+    tables = sa_expressions.db_create(None, metadata, indexed=True)
+
+    if deferred:
+        create_tables(engine, tables)
+    else:
+        metadata.create_all(engine)
+    report = load_tables(engine, tables, directory, chunk_size)
+
+    begin = timeit.default_timer()
+    if deferred:
+        create_indexes(engine, tables)
+    report.append(('indexes', 0, timeit.default_timer() - begin))
+
+    engine.dispose()
+    return report
+
+
+def load_orm(path, directory, chunk_size=datagen.CHUNK_SIZE, deferred=True):
+    engine = use_profile(create_engine('sqlite:///' + path), 'bulk-load')
+    tables = dict((model.__tablename__, model.__table__)
+                  for model in sa_orm.LOAD_ORDER)
+
+    sa_orm.db_create(engine, indexed=not deferred)
+    report = load_tables(engine, tables, directory, chunk_size)
+
+    begin = timeit.default_timer()
+    if deferred:
+        sa_orm.db_index(engine)
+    report.append(('indexes', 0, timeit.default_timer() - begin))
+
+    engine.dispose()
+    return report
+
+
+LOADERS = {
+    'sqlite': load_sqlite,
+    'sa_expressions': load_expressions,
+    'sa_orm': load_orm
+}
+
+
+def check_round_trip(directory):
+    # every layer loads the same rows back, text that isn't ASCII too.
+    data = dict((name, list(rows))
+                for name, rows in datagen.generate(20).items())
+    data['customers'][0] = (1, u'Zo\xeb', u'M\xfcller', u'zo\xeb@email.com')
+    write_csv(directory, data)
+
+    for name, load in sorted(LOADERS.items()):
+        path = os.path.join(directory, name + '.db')
+        load(path, directory)
+        conn = sqlite3.connect(path)
+        for table in TABLES:
+            rows = conn.execute(
+                'SELECT * FROM %s ORDER BY 1, 2' % table).fetchall()
+            if table == 'orders':
+                # sqlite3 and SQLAlchemy store datetimes as different text.
+                rows = [(id_, customer_id, parse_datetime(init_time))
+                        for id_, customer_id, init_time in rows]
+            assert rows == sorted(data[table]), (name, table)
+        conn.close()
+        os.remove(path)
+
+
+def print_report(name, report):
+    total = sum(elapsed for _, _, elapsed in report)
+    rows = sum(rows for _, rows, _ in report)
+    print '%s: %d rows in %.3fs (%d rows/s)' % (
+        name, rows, total, rows / max(total, 1e-9))
+    for table, rows, elapsed in report:
+        if rows:
+            print '  %15s %10d rows %8.3fs %10d rows/s' % (
+                table, rows, elapsed, rows / max(elapsed, 1e-9))
+        else:
+            print '  %15s %24.3fs' % (table, elapsed)
+    print
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load the tables from CSV files into a file database.')
+    parser.add_argument('--csv', metavar='DIRECTORY',
+                        help='directory with customers.csv, products.csv, '
+                             'orders.csv and order_product.csv; '
+                             'generated when not given')
+    parser.add_argument('--orders', type=int, default=1000000,
+                        help='orders to generate without --csv')
+    parser.add_argument('--layers', nargs='+', choices=sorted(LOADERS),
+                        default=['sqlite', 'sa_expressions', 'sa_orm'])
+    parser.add_argument('--chunk-size', type=int, default=datagen.CHUNK_SIZE)
+    parser.add_argument('--no-defer', dest='deferred', action='store_false',
+                        help='create the indexes before the load')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        check_round_trip(directory)
+
+        csv_directory = args.csv
+        if csv_directory is None:
+            csv_directory = directory
+            write_csv(csv_directory, datagen.generate(args.orders))
+
+        for name in args.layers:
+            path = os.path.join(directory, name + '.db')
+            report = LOADERS[name](path, csv_directory,
+                                   args.chunk_size, args.deferred)
+            print_report(name, report)
+            os.remove(path)
+    finally:
+        shutil.rmtree(directory)
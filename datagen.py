@@ -0,0 +1,67 @@
+import datetime
+import itertools
+import random
+
+
+CHUNK_SIZE = 10000
+
+
+def chunks(rows, size=CHUNK_SIZE):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def sizes(n_orders):
+    n_customers = max(6, n_orders // 10)
+    n_products = max(7, n_orders // 100)
+    return n_customers, n_products
+
+
+def skewed(rnd, n, power):
+    # ids close to 1 are picked much more often than the rest.
+    return int(n * rnd.random() ** power) + 1
+
+
+def customers(n_customers):
+    for i in xrange(1, n_customers + 1):
+        yield (i, 'name%d' % i, 'surname%d' % i, 'user%d@email.com' % i)
+
+
+def products(n_products, seed=0):
+    rnd = random.Random(seed)
+    for i in xrange(1, n_products + 1):
+        yield (i, 'product%d' % i, rnd.randint(1, 100) * 10)
+
+
+def orders(n_orders, n_customers, seed=0, start=None):
+    rnd = random.Random(seed + 1)
+    if start is None:
+        start = datetime.datetime(2017, 1, 1)
+    for i in xrange(1, n_orders + 1):
+        yield (i,
+               skewed(rnd, n_customers, 3),
+               start + datetime.timedelta(minutes=i))
+
+
+def order_product(n_orders, n_products, seed=0):
+    rnd = random.Random(seed + 2)
+    for order_id in xrange(1, n_orders + 1):
+        product_ids = set()
+        for _ in xrange(rnd.randint(1, min(3, n_products))):
+            product_ids.add(skewed(rnd, n_products, 2))
+        for product_id in sorted(product_ids):
+            yield (order_id, product_id)
+
+
+def generate(n_orders, seed=0):
+    n_customers, n_products = sizes(n_orders)
+    return {
+        'customers': customers(n_customers),
+        'products': products(n_products, seed),
+        'orders': orders(n_orders, n_customers, seed),
+        'order_product': order_product(n_orders, n_products, seed)
+    }
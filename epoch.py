@@ -0,0 +1,250 @@
+import argparse
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import timeit
+
+from sqlalchemy import create_engine, MetaData, Integer, type_coerce
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import func
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.types import TypeDecorator, DateTime
+
+import datagen
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECONDS_PER_DAY = 86400 * 1000000
+
+
+# init_time as integer microseconds since 1970-01-01 instead of an ISO
+# string. It is naive like the DateTime columns, and reads back as a
+# datetime.
+class EpochMicroseconds(TypeDecorator):
+    impl = Integer
+
+    @property
+    def python_type(self):
+        return datetime.datetime
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return to_epoch(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return from_epoch(value)
+
+
+def to_epoch(value):
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_epoch(value):
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+def use_epoch(engine):
+    # InitTime columns are epoch microseconds on this engine. Call it
+    # before the engine creates or reads the tables, the dialect keeps
+    # the column types it has seen.
+    engine.dialect.epoch_time = True
+
+
+def is_epoch(type_, dialect):
+    return isinstance(type_, EpochMicroseconds) or \
+        isinstance(type_, InitTime) and getattr(dialect, 'epoch_time', False)
+
+
+# a datetime column that is DATETIME text, or integer epoch
+# microseconds on the engines use_epoch() was called on. The tables are
+# shared, the storage is picked by the engine.
+class InitTime(TypeDecorator):
+    impl = DateTime
+
+    @property
+    def python_type(self):
+        return datetime.datetime
+
+    def load_dialect_impl(self, dialect):
+        if is_epoch(self, dialect):
+            return dialect.type_descriptor(Integer())
+        return dialect.type_descriptor(DateTime())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not is_epoch(self, dialect):
+            return value
+        return to_epoch(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None or not is_epoch(self, dialect):
+            return value
+        return from_epoch(value)
+
+
+# the start of the day of a datetime column, as a datetime. Whether the
+# column is epoch microseconds is only known once the engine compiles it.
+class day_of(FunctionElement):
+    name = 'day_of'
+
+    def __init__(self, column):
+        FunctionElement.__init__(self, column)
+        self.type = column.type
+
+
+@compiles(day_of)
+def compile_day_of(element, compiler, **kw):
+    column = list(element.clauses)[0]
+    if is_epoch(column.type, compiler.dialect):
+        micros = type_coerce(column, Integer)
+        day = micros / MICROSECONDS_PER_DAY * MICROSECONDS_PER_DAY
+    else:
+        day = func.datetime(func.date(column))
+    return compiler.process(day, **kw)
+
+
+def check_storages(directory, n_orders, page_size=100):
+    # both storages, in Core and in the ORM, have to page through the
+    # orders, export them and count them per day alike. The ORM engines
+    # share the models, only one of them stores epoch microseconds.
+    import sa_expressions
+    import sa_orm
+
+    results = []
+    for epoch in (False, True):
+        engine = create_engine('sqlite:///' + os.path.join(
+            directory, 'core%d.db' % epoch))
+        metadata = MetaData()
+        tables = sa_expressions.db_create(None, metadata, indexed=True,
+                                          epoch=epoch)
+        metadata.create_all(engine)
+        conn = engine.connect()
+        sa_expressions.db_load(conn, tables, datagen.generate(n_orders))
+
+        listing, keys = sa_expressions.db_listings(tables)['orders']
+        rows, cursor = [], None
+        while True:
+            page, cursor = sa_expressions.db_page(conn, listing, keys,
+                                                  cursor, page_size)
+            rows.extend(tuple(row) for row in page)
+            if cursor is None:
+                break
+        assert rows == [tuple(row) for row in conn.execute(
+            listing.order_by(*keys)).fetchall()]
+
+        export = sa_expressions.db_export(conn, listing)
+        assert export['init_time'].dtype == 'datetime64[us]'
+        per_day = conn.execute(sa_expressions.db_time_ranges(tables)[
+            'orders_per_day'], begin=EPOCH, end=datetime.datetime.max).\
+            fetchall()
+        results.append((rows, export['init_time'].tolist(),
+                        [tuple(row) for row in per_day]))
+        conn.close()
+
+    for epoch in (False, True):
+        engine = create_engine('sqlite:///' + os.path.join(
+            directory, 'orm%d.db' % epoch))
+        if epoch:
+            sa_orm.use_epoch_time(engine)
+        sa_orm.db_create(engine, indexed=True)
+        session = sa_orm.sessionmaker(bind=engine)()
+        sa_orm.db_bulk_load(session, datagen.generate(n_orders))
+        assert engine.execute('SELECT typeof(init_time) FROM orders').\
+            scalar() == ('integer' if epoch else 'text')
+
+        listing, keys = sa_orm.db_listings(session)['orders']
+        rows, cursor = [], None
+        while True:
+            page, cursor = sa_orm.db_page(listing, keys, cursor, page_size)
+            rows.extend((order.id, order.customer_id, order.init_time)
+                        for order in page)
+            if cursor is None:
+                break
+        results.append((rows, None, sa_orm.db_orders_per_day(
+            session, EPOCH, datetime.datetime.max)))
+        session.close()
+
+    for rows, export, per_day in results[1:]:
+        assert rows == results[0][0] and len(rows) == n_orders
+        assert export is None or export == results[0][1]
+        assert per_day == results[0][2]
+
+
+if __name__ == '__main__':
+    import sa_expressions
+
+    parser = argparse.ArgumentParser(
+        description='Compare init_time stored as DATETIME text and as '
+                    'integer epoch microseconds.')
+    parser.add_argument('--orders', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=30,
+                        help='length of the time ranges')
+    args = parser.parse_args()
+
+    n_customers, _ = datagen.sizes(args.orders)
+    start = datetime.datetime(2017, 1, 1)
+    last = start + datetime.timedelta(minutes=args.orders)
+    rnd = random.Random(0)
+    lookups = []
+    for _ in xrange(args.lookups):
+        begin = start + datetime.timedelta(
+            seconds=rnd.randint(0, int((last - start).total_seconds())))
+        lookups.append((rnd.randint(1, n_customers), begin,
+                        begin + datetime.timedelta(days=args.days)))
+
+    directory = tempfile.mkdtemp()
+    try:
+        check_storages(directory, min(args.orders, 10000))
+        print 'pages, export and days agree in both storages'
+
+        for epoch in (False, True):
+            path = os.path.join(directory, 'epoch%d.db' % epoch)
+            engine = create_engine('sqlite:///' + path)
+            metadata = MetaData()
+            tables = sa_expressions.db_create(None, metadata, indexed=True,
+                                              epoch=epoch)
+            metadata.create_all(engine)
+            with engine.begin() as conn:
+                sa_expressions.db_load(conn, tables,
+                                       datagen.generate(args.orders))
+            size = os.path.getsize(path)
+
+            ranges = sa_expressions.db_time_ranges(tables)
+            conn = engine.connect()
+
+            begin = timeit.default_timer()
+            rows = 0
+            for customer_id, range_begin, range_end in lookups:
+                rows += len(conn.execute(
+                    ranges['customer_orders'], customer_id=customer_id,
+                    begin=range_begin, end=range_end).fetchall())
+            by_customer = timeit.default_timer() - begin
+
+            begin = timeit.default_timer()
+            days = conn.execute(ranges['orders_per_day'],
+                                begin=start, end=last).fetchall()
+            per_day = timeit.default_timer() - begin
+
+            begin = timeit.default_timer()
+            fetched = len(conn.execute(tables['orders'].select()).fetchall())
+            fetch = timeit.default_timer() - begin
+
+            print '%s: %.1f MB' % ('epoch' if epoch else 'datetime',
+                                   size / float(1 << 20))
+            print '  customer range: %.3fms (%d rows in %d lookups)' % (
+                by_customer / len(lookups) * 1000, rows, len(lookups))
+            print '  orders per day: %.3fms (%d days, first %s)' % (
+                per_day * 1000, len(days), days[0])
+            print '  fetch orders:   %.3fs (%.3fus/row)' % (
+                fetch, fetch / fetched * 1e6)
+
+            conn.close()
+            engine.dispose()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,70 @@
+import argparse
+import re
+import sys
+
+import datagen
+from benchmark import LAYERS
+
+
+# listings and count(*) read the whole table anyway, the joins of
+# 9 and 10 have to drive from one full table.
+ALLOWED_SCANS = {1: 1, 2: 1, 3: 1, 7: 1, 9: 1, 10: 1}
+
+FULL_SCAN = re.compile(r'^SCAN (TABLE )?(?P<table>\w+)( AS \w+)?$')
+
+
+def full_scans(plan):
+    tables = []
+    for row in plan:
+        match = FULL_SCAN.match(row[-1])
+        if match and match.group('table') != 'CONSTANT':
+            tables.append(match.group('table'))
+    return tables
+
+
+def check_layer(layer):
+    failed = []
+    for number, query in enumerate(layer.queries(), 1):
+        plan = layer.explain(query)
+        scans = full_scans(plan)
+        ok = len(scans) <= ALLOWED_SCANS.get(number, 0)
+        if not ok:
+            failed.append(number)
+
+        print '  %2d %s' % (number, 'ok' if ok else 'FULL SCAN')
+        for row in plan:
+            print '       %s' % row[-1]
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check that the reference queries use indexes.')
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--layers', nargs='+',
+                        default=[layer.name for layer in LAYERS],
+                        choices=[layer.name for layer in LAYERS])
+    parser.add_argument('--plain', action='store_true',
+                        help='check the schema without indexes')
+    args = parser.parse_args()
+
+    failed = False
+    for layer_class in LAYERS:
+        if layer_class.name not in args.layers:
+            continue
+
+        layer = layer_class()
+        layer.create(indexed=not args.plain)
+        layer.insert(datagen.generate(args.orders))
+
+        print '%s:' % layer.name
+        failures = check_layer(layer)
+        if failures:
+            print '  full table scans in queries %s' % (
+                ', '.join(str(number) for number in failures))
+            failed = True
+        print
+
+        layer.close()
+
+    sys.exit(1 if failed else 0)
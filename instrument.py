@@ -0,0 +1,163 @@
+import atexit
+import bisect
+import contextlib
+import json
+import timeit
+
+from sqlalchemy import event
+
+
+# upper bounds of the histogram buckets, in milliseconds.
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+
+@contextlib.contextmanager
+def count_statements(engine):
+    counter = {'statements': 0}
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        counter['statements'] += 1
+
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds * 1000)] += 1
+        self.total += seconds
+
+    def as_dict(self):
+        bounds = [str(bound) for bound in BUCKETS] + ['inf']
+        return {
+            'total_ms': self.total * 1000,
+            'buckets_ms': dict(zip(bounds, self.counts))
+        }
+
+
+class StatementStats(object):
+    def __init__(self):
+        self.count = 0
+        self.rows = 0
+        self.compile = Histogram()
+        self.execute = Histogram()
+        self.fetch = Histogram()
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'rows': self.rows,
+            'compile': self.compile.as_dict(),
+            'execute': self.execute.as_dict(),
+            'fetch': self.fetch.as_dict()
+        }
+
+
+# compile time is the time between Connection.execute() and the cursor
+# call, execute time is the cursor call itself, fetch time and rows are
+# taken from the fetch methods of the result.
+class Instrumentation(object):
+    def __init__(self):
+        self.stats = {}
+
+    def attach(self, engine, dump_path=None):
+        event.listen(engine, 'before_execute', self.before_execute)
+        event.listen(engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute',
+                     self.after_cursor_execute)
+        event.listen(engine, 'after_execute', self.after_execute)
+
+        if dump_path is not None:
+            atexit.register(self.dump, dump_path)
+        return self
+
+    def detach(self, engine):
+        event.remove(engine, 'before_execute', self.before_execute)
+        event.remove(engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+        event.remove(engine, 'after_cursor_execute',
+                     self.after_cursor_execute)
+        event.remove(engine, 'after_execute', self.after_execute)
+
+    def statement(self, statement):
+        if statement not in self.stats:
+            self.stats[statement] = StatementStats()
+        return self.stats[statement]
+
+    def before_execute(self, conn, clauseelement, multiparams, params):
+        conn.info['instrument_started'] = timeit.default_timer()
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        now = timeit.default_timer()
+        stats = self.statement(statement)
+        stats.count += 1
+
+        started = conn.info.pop('instrument_started', None)
+        if started is not None:
+            stats.compile.add(now - started)
+
+        context._instrument_stats = stats
+        context._instrument_started = now
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        stats = context._instrument_stats
+        stats.execute.add(timeit.default_timer() -
+                          context._instrument_started)
+        if cursor.rowcount > 0:
+            stats.rows += cursor.rowcount
+
+    def after_execute(self, conn, clauseelement, multiparams, params,
+                      result):
+        stats = getattr(result.context, '_instrument_stats', None)
+        if stats is None or not result.returns_rows:
+            return
+
+        # ResultProxy iterates through fetchone() and scalar() calls
+        # first(), which reads its row without the fetch methods. Wrapping
+        # those and first() on the instance covers every way of reading
+        # the rows. The fetch time of a result is recorded once it is
+        # exhausted, first() closes the result.
+        fetched = {'time': 0.0}
+
+        def timed(fetch, exhausts=False):
+            def wrapper(*args):
+                started = timeit.default_timer()
+                rows = fetch(*args)
+                fetched['time'] += timeit.default_timer() - started
+
+                if isinstance(rows, list):
+                    stats.rows += len(rows)
+                elif rows is not None:
+                    stats.rows += 1
+                if exhausts or not rows:
+                    stats.fetch.add(fetched['time'])
+                    fetched['time'] = 0.0
+                return rows
+            return wrapper
+
+        result.fetchone = timed(result.fetchone)
+        result.fetchmany = timed(result.fetchmany)
+        result.fetchall = timed(result.fetchall, exhausts=True)
+        result.first = timed(result.first, exhausts=True)
+
+    def as_dict(self):
+        return dict((statement, stats.as_dict())
+                    for statement, stats in self.stats.items())
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+
+def instrument(engine, dump_path=None):
+    return Instrumentation().attach(engine, dump_path)
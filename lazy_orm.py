@@ -0,0 +1,34 @@
+# Entry point to the sa_orm models for short jobs. Importing it costs
+# nothing: SQLAlchemy and sa_orm are imported by the first call that
+# needs a model, and only the tables of the models a job asks for (and
+# the tables their foreign keys point to) are created. The mappers are
+# configured by SQLAlchemy on the first query, all of them at once.
+
+MODELS = ['Customer', 'Product', 'Order', 'OrderProduct']
+
+
+def models(*names):
+    import sa_orm
+    return [getattr(sa_orm, name) for name in names or MODELS]
+
+
+def tables(*names):
+    needed = []
+    pending = [model.__table__ for model in models(*names)]
+    while pending:
+        table = pending.pop()
+        if table in needed:
+            continue
+        needed.append(table)
+        pending.extend(key.column.table for key in table.foreign_keys)
+    return needed
+
+
+def session(names=(), url='sqlite:///:memory:'):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import sa_orm
+
+    engine = create_engine(url)
+    sa_orm.Base.metadata.create_all(engine, tables=tables(*names))
+    return sessionmaker(bind=engine)()
@@ -0,0 +1,217 @@
+import argparse
+import collections
+import random
+import timeit
+
+from sqlalchemy import select, bindparam
+from sqlalchemy.sql import func
+
+import datagen
+import instrument
+import sa_expressions
+
+
+# Batched lookups of queries 4, 5, 6 and 8. The ids asked for while a
+# request is handled are collected, and the first value that is read
+# runs one IN query per kind for all of them. The rows are split back by
+# the key in their first column, labeled so that the select doesn't fold
+# it into the same column of the table.
+
+BATCH_SIZE = 100
+
+
+def batch_queries(tables):
+    products = tables['products']
+    orders = tables['orders']
+    order_product = tables['order_product']
+
+    ids = bindparam('ids', expanding=True)
+    bought = products.join(order_product).join(orders)
+
+    # 8. counts every product of a customer once, like query 8.
+    bought_prices = select([orders.c.customer_id, products.c.id,
+                            products.c.price]).\
+        select_from(bought).where(orders.c.customer_id.in_(ids)).\
+        distinct().alias('bought_prices')
+
+    return {
+        # 4. get all orders for a current customer.
+        'orders': select([orders.c.customer_id.label('key'), orders]).\
+            where(orders.c.customer_id.in_(ids)),
+
+        # 5. get all products for a current order.
+        'order_products': select([order_product.c.order_id.label('key'),
+                                   products]).\
+            select_from(products.join(order_product)).\
+            where(order_product.c.order_id.in_(ids)),
+
+        # 6. get all products for a current customer.
+        'customer_products': select([orders.c.customer_id.label('key'),
+                                      products]).\
+            select_from(bought).where(orders.c.customer_id.in_(ids)).\
+            distinct(),
+
+        # 8. get money amount that customer leaves for us:
+        'spend': select([bought_prices.c.customer_id,
+                         func.sum(bought_prices.c.price)]).\
+            group_by(bought_prices.c.customer_id)
+    }
+
+
+class Pending(object):
+    def __init__(self, loader, kind, key):
+        self.loader = loader
+        self.kind = kind
+        self.key = key
+
+    @property
+    def value(self):
+        return self.loader.get(self.kind, self.key)
+
+
+class BatchLoader(object):
+    def __init__(self, conn, tables, batch_size=BATCH_SIZE):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.queries = batch_queries(tables)
+        # the keys of a kind in the order they were asked for, once each.
+        self.pending = collections.defaultdict(collections.OrderedDict)
+        self.results = {}
+
+    def load(self, kind, key):
+        if (kind, key) not in self.results:
+            self.pending[kind][key] = None
+        return Pending(self, kind, key)
+
+    def get(self, kind, key):
+        if (kind, key) not in self.results:
+            self.dispatch()
+        return self.results[(kind, key)]
+
+    def dispatch(self):
+        for kind, keys in self.pending.items():
+            for batch in datagen.chunks(keys.keys(), self.batch_size):
+                self.fetch(kind, batch)
+        self.pending.clear()
+
+    def fetch(self, kind, keys):
+        rows = self.conn.execute(self.queries[kind], ids=keys)
+        if kind == 'spend':
+            # no orders, no sum.
+            values = dict(rows.fetchall())
+            for key in keys:
+                self.results[(kind, key)] = values.get(key)
+            return
+
+        for key in keys:
+            self.results[(kind, key)] = []
+        for row in rows:
+            self.results[(kind, row[0])].append(tuple(row)[1:])
+
+    def clear(self):
+        # a loader lives for one request, the next one reads fresh rows.
+        self.results.clear()
+
+
+def handle_loop(catalog, conn, customer_ids, order_ids):
+    # one statement per id and query.
+    response = {}
+    for customer_id in customer_ids:
+        response[customer_id] = (
+            [tuple(row) for row in
+             catalog.execute(conn, 4, customer_id=customer_id)],
+            [tuple(row) for row in
+             catalog.execute(conn, 6, customer_id=customer_id)],
+            catalog.execute(conn, 8, customer_id=customer_id).scalar())
+    for order_id in order_ids:
+        response[-order_id] = [
+            tuple(row) for row in catalog.execute(conn, 5, order_id=order_id)]
+    return response
+
+
+def handle_batched(loader, customer_ids, order_ids):
+    pending = {}
+    for customer_id in customer_ids:
+        pending[customer_id] = (
+            loader.load('orders', customer_id),
+            loader.load('customer_products', customer_id),
+            loader.load('spend', customer_id))
+    for order_id in order_ids:
+        pending[-order_id] = loader.load('order_products', order_id)
+
+    response = {}
+    for key, value in pending.items():
+        if isinstance(value, tuple):
+            response[key] = tuple(item.value for item in value)
+        else:
+            response[key] = value.value
+    loader.clear()
+    return response
+
+
+def same(loop, batched):
+    # the order of rows of an IN query differs from the single lookups.
+    def normalize(value):
+        return sorted(value) if isinstance(value, list) else value
+    return all(
+        [normalize(item) for item in loop[key]] ==
+        [normalize(item) for item in batched[key]]
+        if isinstance(loop[key], tuple)
+        else normalize(loop[key]) == normalize(batched[key])
+        for key in loop)
+
+
+if __name__ == '__main__':
+    from benchmark import ExpressionsLayer, percentile
+
+    parser = argparse.ArgumentParser(
+        description='Compare per-id lookups with the batch loader.')
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--customers', type=int, default=50,
+                        help='customers per request')
+    parser.add_argument('--order-ids', type=int, default=50,
+                        help='orders per request')
+    parser.add_argument('--batch-size', type=int, nargs='+',
+                        default=[10, BATCH_SIZE, 1000])
+    args = parser.parse_args()
+
+    layer = ExpressionsLayer()
+    layer.create(indexed=True)
+    layer.insert(datagen.generate(args.orders))
+
+    n_customers, _ = datagen.sizes(args.orders)
+    rnd = random.Random(0)
+    requests = [([rnd.randint(1, n_customers)
+                  for _ in xrange(args.customers)],
+                 [rnd.randint(1, args.orders)
+                  for _ in xrange(args.order_ids)])
+                for _ in xrange(args.requests)]
+
+    def run(name, handle):
+        timings = []
+        responses = []
+        with instrument.count_statements(layer.engine) as counter:
+            for customer_ids, order_ids in requests:
+                begin = timeit.default_timer()
+                responses.append(handle(customer_ids, order_ids))
+                timings.append(timeit.default_timer() - begin)
+        print '%-16s %8.1f %10.3f %10.3f' % (
+            name, float(counter['statements']) / len(requests),
+            percentile(timings, 50) * 1000, percentile(timings, 95) * 1000)
+        return responses
+
+    print '%-16s %8s %10s %10s' % ('', 'trips', 'p50 ms', 'p95 ms')
+    catalog = sa_expressions.QueryCatalog(layer.tables, layer.conn.dialect)
+    expected = run('per id', lambda customer_ids, order_ids: handle_loop(
+        catalog, layer.conn, customer_ids, order_ids))
+
+    for batch_size in args.batch_size:
+        loader = BatchLoader(layer.conn, layer.tables, batch_size)
+        responses = run('batch of %d' % batch_size,
+                        lambda customer_ids, order_ids: handle_batched(
+                            loader, customer_ids, order_ids))
+        assert all(same(loop, batched)
+                   for loop, batched in zip(expected, responses))
+
+    layer.close()
@@ -0,0 +1,151 @@
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import timeit
+
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import create_engine, MetaData
+from sqlalchemy.orm import sessionmaker, scoped_session
+
+import datagen
+import sa_expressions
+import sa_orm
+
+
+# Concurrent "orders for customer X" and "spend of customer X" lookups
+# (queries 4 and 8). The modules are Python 2, which has no asyncio, so
+# the lookups are offloaded to a thread pool instead: sqlite3 releases
+# the GIL while a statement runs, the same thing an async SQLite driver
+# relies on. Every worker thread keeps its own connection to a file
+# database, in-memory databases can't be shared between connections.
+
+
+class CoreLookups(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.local = threading.local()
+        self.connections = []
+
+        metadata = MetaData()
+        tables = sa_expressions.db_create(None, metadata)
+        self.catalog = sa_expressions.QueryCatalog(tables, engine.dialect)
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.engine.connect()
+            self.connections.append(conn)
+        return conn
+
+    def __call__(self, customer_id):
+        conn = self.connection()
+        orders = self.catalog.execute(
+            conn, 4, customer_id=customer_id).fetchall()
+        spend = self.catalog.execute(
+            conn, 8, customer_id=customer_id).scalar()
+        return customer_id, len(orders), spend
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+
+
+class OrmLookups(object):
+    def __init__(self, engine):
+        self.Session = scoped_session(sessionmaker(bind=engine))
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    def __call__(self, customer_id):
+        session = self.Session()
+        with self.lock:
+            if session not in self.sessions:
+                self.sessions.append(session)
+
+        orders = sa_orm.db_customer_orders(session, customer_id)
+        spend = sa_orm.db_customer_spend(session, customer_id)
+        # nothing is changed, release the read transaction.
+        session.rollback()
+        return customer_id, len(orders), spend
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+
+
+def run_sequential(lookup, customer_ids):
+    begin = timeit.default_timer()
+    results = [lookup(customer_id) for customer_id in customer_ids]
+    return results, timeit.default_timer() - begin
+
+
+def run_concurrent(lookup, customer_ids, workers):
+    pool = ThreadPool(workers)
+    begin = timeit.default_timer()
+    results = pool.map(lookup, customer_ids)
+    elapsed = timeit.default_timer() - begin
+    pool.close()
+    pool.join()
+    return results, elapsed
+
+
+def create_database(path, n_orders, seed=0):
+    engine = create_engine('sqlite:///' + path)
+    metadata = MetaData()
+    tables = sa_expressions.db_create(None, metadata, indexed=True)
+    metadata.create_all(engine)
+
+    with engine.begin() as conn:
+        sa_expressions.db_load(conn, tables, datagen.generate(n_orders, seed))
+    engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run per-customer lookups sequentially and '
+                    'concurrently.')
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--customers', type=int, default=1000,
+                        help='number of customers to look up')
+    parser.add_argument('--workers', type=int, nargs='+', default=[4, 8])
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'lookups.db')
+    try:
+        create_database(path, args.orders)
+
+        n_customers, _ = datagen.sizes(args.orders)
+        rnd = random.Random(0)
+        customer_ids = [rnd.randint(1, n_customers)
+                        for _ in xrange(args.customers)]
+
+        for name, lookups in (('core', CoreLookups), ('orm', OrmLookups)):
+            # the connections are closed from the main thread.
+            engine = create_engine(
+                'sqlite:///' + path,
+                connect_args={'check_same_thread': False})
+
+            lookup = lookups(engine)
+            expected, elapsed = run_sequential(lookup, customer_ids)
+            lookup.close()
+            print '%s sequential: %.3fs (%d customers/s)' % (
+                name, elapsed, len(customer_ids) / elapsed)
+
+            for workers in args.workers:
+                lookup = lookups(engine)
+                results, elapsed = run_concurrent(
+                    lookup, customer_ids, workers)
+                lookup.close()
+                assert results == expected
+                print '%s %d workers: %.3fs (%d customers/s)' % (
+                    name, workers, elapsed, len(customer_ids) / elapsed)
+
+            engine.dispose()
+            print
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,105 @@
+import argparse
+import base64
+import datetime
+import json
+import timeit
+
+from sqlalchemy import literal, tuple_
+
+
+# Keyset pagination: a page starts after the sort keys of the last row
+# of the previous page instead of skipping OFFSET rows, so an index on
+# the keys finds the start of any page at once. The cursor handed to the
+# client is the keys of that row, JSON in URL-safe base64.
+
+PAGE_SIZE = 100
+
+DATETIME = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps([
+        value.strftime(DATETIME)
+        if isinstance(value, datetime.datetime) else value
+        for value in values]))
+
+
+def decode_cursor(cursor, keys):
+    values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    return [datetime.datetime.strptime(value, DATETIME)
+            if key.type.python_type is datetime.datetime else value
+            for key, value in zip(keys, values)]
+
+
+def after(keys, values):
+    # a row value comparison, SQLite seeks an index on the keys with it.
+    # The values are bound with the types of their keys, an untyped
+    # datetime would be compared as text with an epoch column.
+    if len(keys) == 1:
+        return keys[0] > values[0]
+    return tuple_(*keys) > tuple_(*[literal(value, key.type)
+                                    for key, value in zip(keys, values)])
+
+
+if __name__ == '__main__':
+    import datagen
+    import sa_expressions
+    import sa_orm
+    from benchmark import ExpressionsLayer, OrmBulkLayer
+
+    parser = argparse.ArgumentParser(
+        description='Compare OFFSET and keyset pages of the orders listing '
+                    'at growing depths.')
+    parser.add_argument('--orders', type=int, default=1000000)
+    parser.add_argument('--limit', type=int, default=PAGE_SIZE)
+    parser.add_argument('--depths', type=int, nargs='+',
+                        default=[0, 1000, 10000, 100000, 500000, 900000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    def measure(fetch):
+        begin = timeit.default_timer()
+        for _ in xrange(args.repeat):
+            rows = fetch()
+        return rows, (timeit.default_timer() - begin) / args.repeat
+
+    for layer_class in (ExpressionsLayer, OrmBulkLayer):
+        layer = layer_class()
+        layer.create(indexed=True)
+        layer.insert(datagen.generate(args.orders))
+
+        if layer.name == 'sa_orm_bulk':
+            listing, keys = sa_orm.db_listings(layer.session)['orders']
+            offset_page = lambda depth: \
+                listing.order_by(*keys).offset(depth).limit(args.limit).all()
+            keyset_page = lambda cursor: \
+                sa_orm.db_page(listing, keys, cursor, args.limit)[0]
+            key_at = lambda depth: \
+                listing.with_entities(*keys).order_by(*keys).\
+                    offset(depth - 1).limit(1).one()
+        else:
+            listing, keys = sa_expressions.db_listings(layer.tables)['orders']
+            offset_page = lambda depth: layer.conn.execute(
+                listing.order_by(*keys).offset(depth).limit(args.limit)).\
+                fetchall()
+            keyset_page = lambda cursor: sa_expressions.db_page(
+                layer.conn, listing, keys, cursor, args.limit)[0]
+            key_at = lambda depth: layer.conn.execute(
+                listing.with_only_columns(keys).order_by(*keys).
+                offset(depth - 1).limit(1)).fetchone()
+
+        print '%s:' % layer.name
+        print '  %8s %12s %12s' % ('depth', 'offset ms', 'keyset ms')
+        for depth in args.depths:
+            if depth >= args.orders:
+                continue
+            cursor = encode_cursor(key_at(depth)) if depth else None
+
+            expected, by_offset = measure(lambda: offset_page(depth))
+            rows, by_keyset = measure(lambda: keyset_page(cursor))
+            assert rows == expected
+            print '  %8d %12.3f %12.3f' % (
+                depth, by_offset * 1000, by_keyset * 1000)
+        print
+
+        layer.close()
@@ -0,0 +1,139 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import timeit
+
+import datagen
+
+
+# page_size has to come first: it only applies to a new database and
+# can't be changed once the database is in WAL mode.
+PROFILES = {
+    'bulk-load': [
+        ('page_size', 65536),
+        ('journal_mode', 'OFF'),
+        ('synchronous', 'OFF'),
+        ('cache_size', -262144),
+        ('temp_store', 'MEMORY'),
+        ('mmap_size', 0)
+    ],
+    'read-heavy': [
+        ('page_size', 4096),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -65536),
+        ('temp_store', 'MEMORY'),
+        ('mmap_size', 1 << 30)
+    ],
+    'durable': [
+        ('page_size', 4096),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'FULL'),
+        ('cache_size', -2000),
+        ('temp_store', 'DEFAULT'),
+        ('mmap_size', 0)
+    ]
+}
+
+
+def check_profile(profile):
+    if profile not in PROFILES:
+        raise ValueError('unknown profile %r, expected one of %s' % (
+            profile, ', '.join(sorted(PROFILES))))
+
+
+def apply_profile(curr, profile):
+    # journal_mode can't be changed inside a transaction, so this has to
+    # run before the first 'begin'.
+    check_profile(profile)
+    for name, value in PROFILES[profile]:
+        curr.execute('PRAGMA %s=%s' % (name, value))
+
+
+def use_profile(engine, profile):
+    # SQLAlchemy is imported here and in run_sa_raw only: sqlite imports
+    # this module and has to stay free of it.
+    from sqlalchemy import event
+
+    check_profile(profile)
+
+    def connect(dbapi_conn, connection_record):
+        curr = dbapi_conn.cursor()
+        apply_profile(curr, profile)
+        curr.close()
+
+    event.listen(engine, 'connect', connect)
+    return engine
+
+
+def run_sqlite(path, profile, n_orders):
+    # sqlite imports apply_profile from here.
+    import sqlite
+
+    conn = sqlite3.connect(path)
+    conn.isolation_level = None
+    curr = conn.cursor()
+    apply_profile(curr, profile)
+
+    begin = timeit.default_timer()
+    curr.execute('begin')
+    sqlite.db_create(curr, indexed=True)
+    rows = sqlite.db_load(curr, datagen.generate(n_orders))
+    curr.execute('commit')
+    inserted = timeit.default_timer() - begin
+
+    begin = timeit.default_timer()
+    for text in sqlite.QUERIES:
+        curr.execute(text).fetchall()
+    selected = timeit.default_timer() - begin
+
+    conn.close()
+    return rows, inserted, selected
+
+
+def run_sa_raw(path, profile, n_orders):
+    from sqlalchemy import create_engine
+    import sa_raw
+
+    engine = use_profile(create_engine('sqlite:///' + path), profile)
+
+    begin = timeit.default_timer()
+    with engine.begin() as conn:
+        sa_raw.db_create(conn, indexed=True)
+        rows = sa_raw.db_load(conn, datagen.generate(n_orders))
+    inserted = timeit.default_timer() - begin
+
+    begin = timeit.default_timer()
+    with engine.connect() as conn:
+        for text in sa_raw.QUERIES:
+            conn.execute(text).fetchall()
+    selected = timeit.default_timer() - begin
+
+    engine.dispose()
+    return rows, inserted, selected
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare insert and select throughput of the '
+                    'PRAGMA profiles on a file database.')
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--profiles', nargs='+', choices=sorted(PROFILES),
+                        default=sorted(PROFILES))
+    args = parser.parse_args()
+
+    for name, run in (('sqlite', run_sqlite), ('sa_raw', run_sa_raw)):
+        for profile in args.profiles:
+            directory = tempfile.mkdtemp()
+            try:
+                rows, inserted, selected = run(
+                    os.path.join(directory, 'profile.db'),
+                    profile, args.orders)
+            finally:
+                shutil.rmtree(directory)
+
+            print '%s %s: insert %.3fs (%d rows/s), 11 queries %.3fs' % (
+                name, profile, inserted, rows / inserted, selected)
+        print
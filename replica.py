@@ -0,0 +1,255 @@
+import argparse
+import contextlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import timeit
+
+import datagen
+import sqlite
+
+
+# An in-memory copy of a database file that serves the read queries. A
+# refresh copies the file into a new in-memory database and swaps it in,
+# the readers keep the snapshot they got until they are done with it, so
+# they never wait for a refresh.
+
+
+def copy_database(path, target):
+    if hasattr(target, 'backup'):
+        # the backup API of sqlite3, Python 3.7 and later.
+        source = sqlite3.connect(path)
+        source.backup(target)
+        source.close()
+        return
+
+    # the sqlite3 of Python 2 has no backup API: the schema and the rows
+    # are copied from the attached file in one read transaction, so the
+    # copy is consistent even while the file is written.
+    isolation_level = target.isolation_level
+    target.isolation_level = None
+    target.execute('ATTACH DATABASE ? AS source', (path,))
+    try:
+        target.execute('BEGIN')
+        schema = target.execute(
+            "SELECT type, name, sql FROM source.sqlite_master "
+            "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+            "ORDER BY type = 'table' DESC").fetchall()
+        for kind, name, sql in schema:
+            target.execute(sql)
+            if kind == 'table':
+                target.execute(
+                    'INSERT INTO main."%s" SELECT * FROM source."%s"' % (
+                        name, name))
+        target.execute('COMMIT')
+    finally:
+        target.execute('DETACH DATABASE source')
+        target.isolation_level = isolation_level
+
+
+class Snapshot(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.refreshing = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.current = None
+
+        # data_version changes whenever another connection commits to
+        # the file.
+        self.monitor = sqlite3.connect(path, check_same_thread=False)
+        self.refresh()
+
+    def refresh(self):
+        with self.refreshing:
+            version = self.data_version()
+            taken = time.time()
+            begin = timeit.default_timer()
+
+            # an in-memory database can't be opened twice, so the readers
+            # of all threads take turns on its one connection.
+            conn = sqlite3.connect(':memory:', check_same_thread=False)
+            copy_database(self.path, conn)
+
+            snapshot = {
+                'conn': conn,
+                'engine': None,
+                'lock': threading.Lock(),
+                'readers': 0,
+                'taken': taken,
+                'version': version,
+                'copy_time': timeit.default_timer() - begin
+            }
+            with self.lock:
+                previous, self.current = self.current, snapshot
+                idle = previous is not None and previous['readers'] == 0
+            # otherwise the last reader of the previous one closes it.
+            if idle:
+                close_snapshot(previous)
+
+    def data_version(self):
+        with self.lock:
+            return self.monitor.execute('PRAGMA data_version').fetchone()[0]
+
+    def acquire(self):
+        with self.lock:
+            snapshot = self.current
+            snapshot['readers'] += 1
+        snapshot['lock'].acquire()
+        return snapshot
+
+    def release(self, snapshot):
+        snapshot['lock'].release()
+        with self.lock:
+            snapshot['readers'] -= 1
+            replaced = snapshot['readers'] == 0 and \
+                snapshot is not self.current
+        if replaced:
+            close_snapshot(snapshot)
+
+    @contextlib.contextmanager
+    def connection(self):
+        # the sqlite3 connection of the current snapshot, for one reader
+        # at a time. A refresh meanwhile doesn't wait for it.
+        snapshot = self.acquire()
+        try:
+            yield snapshot['conn']
+        finally:
+            self.release(snapshot)
+
+    @contextlib.contextmanager
+    def engine_connection(self):
+        # the same through a SQLAlchemy engine, made on first use.
+        snapshot = self.acquire()
+        try:
+            if snapshot['engine'] is None:
+                snapshot['engine'] = make_engine(snapshot['conn'])
+            with snapshot['engine'].connect() as conn:
+                yield conn
+        finally:
+            self.release(snapshot)
+
+    def staleness(self):
+        with self.lock:
+            snapshot = self.current
+        return {
+            'age': time.time() - snapshot['taken'],
+            'changed': self.data_version() != snapshot['version'],
+            'copy_time': snapshot['copy_time']
+        }
+
+    def start(self, interval):
+        # refresh every interval seconds on a background thread.
+        def run():
+            while not self.stopped.wait(interval):
+                self.refresh()
+
+        self.thread = threading.Thread(target=run, name='snapshot-refresh')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.monitor.close()
+        with self.lock:
+            snapshot, self.current = self.current, None
+            # readers still at work close it when they are done.
+            idle = snapshot['readers'] == 0
+        if idle:
+            close_snapshot(snapshot)
+
+
+def close_snapshot(snapshot):
+    if snapshot['engine'] is not None:
+        snapshot['engine'].dispose()
+    snapshot['conn'].close()
+
+
+def make_engine(conn):
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import StaticPool
+
+    # every checkout hands out the one connection of the snapshot.
+    return create_engine('sqlite://', poolclass=StaticPool,
+                         creator=lambda: conn)
+
+
+def run_queries(conn):
+    return sum(len(conn.execute(text).fetchall()) for text in sqlite.QUERIES)
+
+
+if __name__ == '__main__':
+    from lookups import create_database
+
+    parser = argparse.ArgumentParser(
+        description='Serve the 11 queries from an in-memory snapshot of '
+                    'a database file while the file is written.')
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between refreshes')
+    parser.add_argument('--seconds', type=float, default=5.0,
+                        help='how long to run')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'replica.db')
+    try:
+        create_database(path, args.orders)
+
+        disk = sqlite3.connect(path)
+        begin = timeit.default_timer()
+        run_queries(disk)
+        print '11 queries on the file:     %.3fs' % (
+            timeit.default_timer() - begin)
+
+        snapshot = Snapshot(path)
+        print 'snapshot copied in          %.3fs' % (
+            snapshot.staleness()['copy_time'])
+
+        begin = timeit.default_timer()
+        with snapshot.connection() as conn:
+            run_queries(conn)
+        print '11 queries on the snapshot: %.3fs' % (
+            timeit.default_timer() - begin)
+
+        begin = timeit.default_timer()
+        with snapshot.engine_connection() as conn:
+            run_queries(conn)
+        print '11 queries through engine:  %.3fs' % (
+            timeit.default_timer() - begin)
+
+        # a writer adds orders to the file, the snapshot is refreshed in
+        # the background and a reader keeps querying it.
+        snapshot.start(args.interval)
+        n_customers, _ = datagen.sizes(args.orders)
+        order_id = args.orders
+        deadline = timeit.default_timer() + args.seconds
+        reads = 0
+        while timeit.default_timer() < deadline:
+            order_id += 1
+            disk.execute('INSERT INTO orders VALUES (?, ?, datetime())',
+                         (order_id, order_id % n_customers + 1))
+            disk.commit()
+
+            with snapshot.connection() as conn:
+                count = conn.execute(
+                    'SELECT count(*) FROM orders').fetchone()[0]
+            reads += 1
+            if reads % 200 == 0:
+                staleness = snapshot.staleness()
+                print 'orders on file %d, on snapshot %d, snapshot ' \
+                      'age %.2fs, changed since %s' % (
+                          order_id, count, staleness['age'],
+                          staleness['changed'])
+            time.sleep(0.005)
+
+        snapshot.stop()
+        disk.close()
+    finally:
+        shutil.rmtree(directory)
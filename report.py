@@ -0,0 +1,132 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import timeit
+
+from multiprocessing import Pool
+
+from sqlalchemy import create_engine, event, MetaData
+from sqlalchemy.exc import OperationalError
+
+import sa_expressions
+from streaming import print_record, null_sink
+
+
+# The report of db_select, the 11 queries and the per-customer queries
+# for every customer, run on a process pool. Every worker holds one
+# read-only connection to the database file. The results come back in
+# the order of the tasks, whatever worker ran them.
+
+PER_CUSTOMER = [4, 6, 8, 11]
+
+
+def make_tasks(n_customers, per_customer=True):
+    tasks = [(number, {}) for number in xrange(1, 12)]
+    if per_customer:
+        tasks.extend((number, {'customer_id': customer_id})
+                     for customer_id in xrange(1, n_customers + 1)
+                     for number in PER_CUSTOMER)
+    return tasks
+
+
+def read_only(dbapi_conn, connection_record):
+    # sqlite3 of Python 2 can't open a file read-only through an URI.
+    dbapi_conn.execute('PRAGMA query_only = ON')
+
+
+# the connection and the queries of a pool worker.
+worker = {}
+
+
+def open_database(path):
+    engine = create_engine('sqlite:///' + path)
+    event.listen(engine, 'connect', read_only)
+    worker['conn'] = engine.connect()
+    worker['catalog'] = sa_expressions.QueryCatalog(
+        sa_expressions.db_create(None, MetaData()), engine.dialect)
+
+
+def run_task(task):
+    number, params = task
+    result = worker['catalog'].execute(worker['conn'], number, **params)
+    return number, params, [tuple(row) for row in result]
+
+
+def run_serial(path, tasks, sink):
+    open_database(path)
+    begin = timeit.default_timer()
+    rows = 0
+    for number, params, records in (run_task(task) for task in tasks):
+        for record in records:
+            sink(record)
+        rows += len(records)
+    elapsed = timeit.default_timer() - begin
+    worker['conn'].close()
+    return rows, elapsed
+
+
+def run_parallel(path, tasks, sink, processes, chunksize=16):
+    pool = Pool(processes, open_database, (path,))
+    begin = timeit.default_timer()
+    rows = 0
+    for number, params, records in pool.imap(run_task, tasks, chunksize):
+        for record in records:
+            sink(record)
+        rows += len(records)
+    elapsed = timeit.default_timer() - begin
+    pool.close()
+    pool.join()
+    return rows, elapsed
+
+
+if __name__ == '__main__':
+    from lookups import create_database
+
+    parser = argparse.ArgumentParser(
+        description='Run the report serially and on process pools.')
+    parser.add_argument('--database', metavar='PATH',
+                        help='database file to report on; generated '
+                             'when not given or when it does not exist')
+    parser.add_argument('--orders', type=int, default=100000,
+                        help='orders to generate')
+    parser.add_argument('--processes', type=int, nargs='+',
+                        default=sorted(set([1, 2, multiprocessing.cpu_count()])))
+    parser.add_argument('--no-per-customer', dest='per_customer',
+                        action='store_false',
+                        help='run the 11 queries only')
+    parser.add_argument('--print', dest='sink', action='store_const',
+                        const=print_record, default=null_sink,
+                        help='print the records')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = args.database
+        if path is None:
+            path = os.path.join(directory, 'report.db')
+        if not os.path.exists(path):
+            create_database(path, args.orders)
+
+        engine = create_engine('sqlite:///' + path)
+        try:
+            n_customers = engine.execute(
+                'SELECT max(id) FROM customers').scalar()
+        except OperationalError:
+            n_customers = None
+        engine.dispose()
+        if n_customers is None:
+            parser.exit(1, '%s has no customers, remove it to report on '
+                           '%d generated orders\n' % (path, args.orders))
+        tasks = make_tasks(n_customers, args.per_customer)
+
+        rows, serial = run_serial(path, tasks, args.sink)
+        print 'serial: %d tasks, %d rows in %.3fs' % (len(tasks), rows, serial)
+        for processes in args.processes:
+            rows, elapsed = run_parallel(path, tasks, args.sink, processes)
+            print '%d processes: %.3fs, speedup %.2fx (%d cores)' % (
+                processes, elapsed, serial / elapsed,
+                multiprocessing.cpu_count())
+    finally:
+        shutil.rmtree(directory)
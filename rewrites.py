@@ -0,0 +1,68 @@
+import argparse
+import timeit
+
+import datagen
+from benchmark import LAYERS, percentile
+
+
+def measure(layer, query, repeat):
+    timings = []
+    for _ in xrange(repeat):
+        begin = timeit.default_timer()
+        rows = layer.fetch(query)
+        timings.append(timeit.default_timer() - begin)
+    return sorted(repr(row) for row in rows), percentile(timings, 50)
+
+
+def run_layer(layer, repeat):
+    # a rewrite that means something else than its query on purpose is
+    # compared with a baseline of the same meaning, marked with a *.
+    queries = layer.queries()
+    baselines = layer.rewrite_baselines()
+    for number, label, query in layer.rewrites():
+        baseline = baselines.get(number, queries[number - 1])
+        expected, original = measure(layer, baseline, repeat)
+        rows, rewritten = measure(layer, query, repeat)
+        yield ('%d %s%s' % (number, label, '*' if number in baselines
+                            else ''), original, rewritten, rows == expected)
+
+    latest_orders = layer.latest_orders()
+    expected, original = measure(layer, latest_orders[0][1], repeat)
+    for label, query in latest_orders[1:]:
+        rows, rewritten = measure(layer, query, repeat)
+        yield 'latest %s' % label, original, rewritten, rows == expected
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare the rewritten queries with the originals.')
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--layers', nargs='+',
+                        default=['sqlite', 'sa_expressions', 'sa_orm'],
+                        choices=[layer.name for layer in LAYERS])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--plain', action='store_true',
+                        help='use the schema without indexes')
+    args = parser.parse_args()
+
+    for layer_class in LAYERS:
+        if layer_class.name not in args.layers:
+            continue
+
+        layer = layer_class()
+        layer.create(indexed=not args.plain)
+        layer.insert(datagen.generate(args.orders))
+
+        print '%s:' % layer.name
+        print '  %-20s %12s %12s %8s' % (
+            'query', 'original ms', 'rewrite ms', 'same')
+        for name, original, rewritten, same in run_layer(layer, args.repeat):
+            print '  %-20s %12.3f %12.3f %8s' % (
+                name, original * 1000, rewritten * 1000,
+                'yes' if same else 'NO')
+        if layer.rewrite_baselines():
+            print '  * against the IN form of the query, the ORM query 8 ' \
+                  'adds a product once per order line'
+        print
+
+        layer.close()
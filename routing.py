@@ -0,0 +1,121 @@
+import argparse
+import collections
+import os
+import shutil
+import tempfile
+import timeit
+
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import datagen
+import sa_orm
+
+
+# A primary file and replica files that are copies of it, the copy
+# stands in for replication. Writes go to the primary through
+# sa_orm.RoutingSession, reads are spread over the replicas.
+
+
+def count_statements(engines):
+    counts = collections.Counter()
+
+    def listener(name):
+        def count(conn, cursor, statement, parameters, context,
+                  executemany):
+            counts[name] += 1
+        return count
+
+    for name, engine in engines.items():
+        event.listen(engine, 'before_cursor_execute', listener(name))
+    return counts
+
+
+def replicate(primary_path, replica_paths):
+    for path in replica_paths:
+        shutil.copyfile(primary_path, path)
+
+
+def read_report(Session):
+    session = Session()
+    rows = sum(len(query.all()) for query in sa_orm.db_queries(session))
+    session.close()
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Send ORM writes to a primary and reads to replicas.')
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--replicas', type=int, default=2)
+    parser.add_argument('--reports', type=int, default=40)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        primary_path = os.path.join(directory, 'primary.db')
+        replica_paths = [os.path.join(directory, 'replica%d.db' % i)
+                         for i in xrange(args.replicas)]
+
+        primary = create_engine('sqlite:///' + primary_path)
+        sa_orm.db_create(primary, indexed=True)
+        replicas = [create_engine('sqlite:///' + path)
+                    for path in replica_paths]
+        engines = dict([('primary', primary)] +
+                       [('replica%d' % i, engine)
+                        for i, engine in enumerate(replicas)])
+        counts = count_statements(engines)
+
+        # the load goes to the primary only.
+        Session = sessionmaker(class_=sa_orm.RoutingSession,
+                               primary=primary,
+                               replicas=sa_orm.ReplicaSet(replicas))
+        session = Session()
+        sa_orm.db_bulk_load(session, datagen.generate(args.orders))
+        session.close()
+        replicate(primary_path, replica_paths)
+        print 'load: %s' % dict(counts)
+
+        for policy in ('round-robin', 'least-busy'):
+            counts.clear()
+            Session = sessionmaker(class_=sa_orm.RoutingSession,
+                                   primary=primary,
+                                   replicas=sa_orm.ReplicaSet(replicas,
+                                                              policy))
+            pool = ThreadPool(args.workers)
+            begin = timeit.default_timer()
+            pool.map(lambda _: read_report(Session), xrange(args.reports),
+                     chunksize=1)
+            elapsed = timeit.default_timer() - begin
+            pool.close()
+            pool.join()
+            print '%s: %d reports in %.3fs, statements %s' % (
+                policy, args.reports, elapsed, dict(counts))
+
+        # a new customer isn't on the replicas until the next copy.
+        for read_your_writes in (False, True):
+            Session = sessionmaker(class_=sa_orm.RoutingSession,
+                                   primary=primary,
+                                   replicas=sa_orm.ReplicaSet(replicas),
+                                   read_your_writes=read_your_writes)
+            session = Session()
+            customer = sa_orm.Customer(
+                name='new', surname='customer',
+                email='new%d@email.com' % read_your_writes)
+            session.add(customer)
+            session.flush()
+            customer_id = customer.id
+            session.commit()
+            session.expunge_all()
+
+            found = session.query(sa_orm.Customer).\
+                filter_by(id=customer_id).first()
+            print 'read_your_writes=%s: customer %d %s' % (
+                read_your_writes, customer_id,
+                'found' if found is not None else 'not found (stale replica)')
+            session.close()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,88 @@
+import argparse
+import gc
+import os
+import shutil
+import tempfile
+import timeit
+
+from multiprocessing import Pool
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import sa_orm
+from benchmark import resident_size
+from lookups import create_database
+
+
+# Memory and time of a listing (2. get all orders) kept as full Order
+# instances and as the read-only rows of sa_orm.db_rows. Every mode runs
+# in a fresh process forked before anything is loaded, and the memory of
+# a mode is the growth of the current resident size while its records
+# are held. The rows are checked against the entities after that.
+
+MODES = {
+    'entities': lambda query: query.all(),
+    'rows': lambda query: list(sa_orm.db_rows(query))
+}
+
+
+def check_rows(path):
+    # the rows print like the entities for every query, and for a LEFT
+    # JOIN of two entities (query 10 with the whole order) as well.
+    engine = create_engine('sqlite:///' + path)
+    session = sessionmaker(bind=engine)()
+    queries = sa_orm.db_queries(session) + [
+        session.query(sa_orm.Customer, sa_orm.Order).outerjoin(
+            sa_orm.Order).order_by(sa_orm.Customer.id, sa_orm.Order.id)]
+    for query in queries:
+        assert repr(query.all()) == repr(list(sa_orm.db_rows(query)))
+    session.close()
+    engine.dispose()
+
+
+def measure(args):
+    path, mode = args
+    engine = create_engine('sqlite:///' + path)
+    session = sessionmaker(bind=engine)()
+    query = sa_orm.db_queries(session)[1]
+
+    gc.collect()
+    rss_before = resident_size()
+    begin = timeit.default_timer()
+    records = MODES[mode](query)
+    elapsed = timeit.default_timer() - begin
+    rss_growth = resident_size() - rss_before
+
+    rows = len(records)
+    session.close()
+    engine.dispose()
+    return rows, elapsed, rss_growth
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare ORM entities and read-only rows on the '
+                    'orders listing.')
+    parser.add_argument('--orders', type=int, default=1000000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'rows.db')
+    try:
+        create_database(path, args.orders)
+
+        for mode in sorted(MODES):
+            pool = Pool(1)
+            rows, elapsed, rss_growth = pool.apply(measure, ((path, mode),))
+            pool.close()
+            pool.join()
+
+            print '%s: %d rows in %.3fs, %.3fus/row, %d bytes/row ' \
+                  '(rss growth %d kB)' % (
+                      mode, rows, elapsed, elapsed / rows * 1e6,
+                      rss_growth * 1024 / rows, rss_growth)
+
+        check_rows(path)
+    finally:
+        shutil.rmtree(directory)
@@ -2,15 +2,22 @@ from sqlalchemy import (
     create_engine, MetaData, Table,
     Column, Integer, Sequence,
     String, ForeignKey, DateTime,
-    select
+    Index, select, bindparam, exists
 )
 
-from sqlalchemy.sql import and_
+from sqlalchemy.sql import and_, func
 
 import datetime
 
+from datagen import chunks, CHUNK_SIZE
+from epoch import EpochMicroseconds, is_epoch, day_of
+from pages import after, encode_cursor, decode_cursor, PAGE_SIZE
+from streaming import (
+    stream, fetch_batches, print_record, BATCH_SIZE
+)
+
 
-def db_create(conn, metadata):
+def db_create(conn, metadata, indexed=False, epoch=False):
     customers = Table('customers', metadata,
                       Column('id', Integer(),
                              Sequence('customer_id_seq'),
@@ -29,10 +36,23 @@ def db_create(conn, metadata):
                           Sequence('orders_id_seq'),
                           primary_key=True),
                    Column('customer_id', Integer, ForeignKey('customers.id')),
-                   Column('init_time', DateTime(), nullable=False))
+                   Column('init_time',
+                          EpochMicroseconds() if epoch else DateTime(),
+                          nullable=False))
     order_product = Table('order_product', metadata,
-                          Column('order_id', Integer, ForeignKey('orders.id')),
-                          Column('product_id', Integer, ForeignKey('products.id')))
+                          Column('order_id', Integer, ForeignKey('orders.id'),
+                                 primary_key=indexed),
+                          Column('product_id', Integer, ForeignKey('products.id'),
+                                 primary_key=indexed))
+
+    if indexed:
+        # orders.id is an alias of rowid, so the indexes are covering.
+        Index('orders_customer_id_init_time_idx',
+              orders.c.customer_id, orders.c.init_time)
+        Index('order_product_product_id_idx',
+              order_product.c.product_id, order_product.c.order_id)
+        # pages of orders by (init_time, id).
+        Index('orders_init_time_idx', orders.c.init_time)
 
     return {
         'customers': customers,
@@ -101,96 +121,295 @@ def db_insert(conn, tables):
     conn.execute(tables['order_product'].insert(), order_product)
 
 
-def db_select(conn, tables):
-    def print_records(select_expr):
-        records = conn.execute(select_expr)
-
-        if records.rowcount == 0:
-            print 'No records.'
-            return
+def db_load(conn, tables, data, chunk_size=CHUNK_SIZE):
+    inserted = 0
+    for name in ('customers', 'products', 'orders', 'order_product'):
+        keys = tables[name].c.keys()
+        for chunk in chunks(data[name], chunk_size):
+            conn.execute(tables[name].insert(),
+                         [dict(zip(keys, row)) for row in chunk])
+            inserted += len(chunk)
+    return inserted
 
-        for record in records:
-            print record
-        print
 
+def db_queries(tables):
     # for more code clarity.
     customers = tables['customers']
     products = tables['products']
     orders = tables['orders']
     order_product = tables['order_product']
 
+    # the ids are bound parameters, so the statements can be compiled
+    # once and executed for any customer and order.
+    customer_id = bindparam('customer_id', 2)
+    order_id = bindparam('order_id', 1)
+
+    queries = []
 
     # 1. get all customers.
-    print_records(
+    queries.append(
         select([customers]))
 
     # 2. get all orders.
-    print_records(
+    queries.append(
         select([orders]))
 
     # 3. get all products.
-    print_records(
+    queries.append(
         select([products]))
 
     # 4. get all orders for a current customer.
-    print_records(
-        select([orders]).where(orders.c.customer_id == 2))
+    queries.append(
+        select([orders]).where(orders.c.customer_id == customer_id))
 
     # 5. get all products for a current order.
-    print_records(
+    queries.append(
         select([products]).where(products.c.id.in_(
             select([order_product.c.product_id]).\
-                where(order_product.c.order_id == 1))))
+                where(order_product.c.order_id == order_id))))
 
     # 6. get all products for a current customer.
-    print_records(
+    queries.append(
         select([products]).\
         where(products.c.id.in_(
             select([order_product.c.product_id]).\
             where(order_product.c.order_id.in_(
                 select([orders.c.id]).\
-                where(orders.c.customer_id == 2))))))
-    # or
-
-    order_ids = select([orders.c.id]).where(orders.c.customer_id == 2)
-    product_ids = select([order_product.c.product_id]).\
-                         where(order_product.c.order_id.in_(order_ids))
-    print_records(
-        select([products]).where(products.c.id.in_(product_ids)))
+                where(orders.c.customer_id == customer_id))))))
 
     # 7. get count of our customers.
-    from sqlalchemy.sql import func
-    print_records(
+    queries.append(
         select([func.count(customers).label('count')]))
 
     # 8. get money amount that customer leaves for us:
-    order_ids = select([orders.c.id]).where(orders.c.customer_id == 2)
+    order_ids = select([orders.c.id]).where(orders.c.customer_id == customer_id)
     product_ids = select([order_product.c.product_id]).\
                   where(order_product.c.order_id.in_(order_ids))
-    print_records(
+    queries.append(
         select([func.sum(products.c.price)]).where(products.c.id.in_(product_ids)))
 
     # 9. get all customers with their orders if exists.
-    print_records(
+    queries.append(
         select([customers,
                 orders.c.id]).where(customers.c.id == orders.c.customer_id).\
                     order_by(customers.c.id))
 
     # 10. get all customers and their orders (and null if not exists).
-    print_records(
+    queries.append(
         select([customers,
                 orders.c.id]).select_from(customers.outerjoin(orders)))
 
     # 11. get the last customer order.
     max_order_time = select([func.max(orders.c.init_time)]).\
-                         where(orders.c.customer_id == 2)
-    print_records(
+                         where(orders.c.customer_id == customer_id)
+    queries.append(
         select([orders, customers]).\
             where(
                 and_(
-                    customers.c.id == 2,
+                    customers.c.id == orders.c.customer_id,
+                    customers.c.id == customer_id,
                     orders.c.init_time == max_order_time)))
 
+    return queries
+
+
+def db_rewrites(tables):
+    # the nested IN queries (6, 8) and the correlated latest order (11)
+    # written with joins, EXISTS and ROW_NUMBER() instead.
+    customers = tables['customers']
+    products = tables['products']
+    orders = tables['orders']
+    order_product = tables['order_product']
+
+    customer_id = bindparam('customer_id', 2)
+
+    customer_lines = orders.join(
+        order_product, order_product.c.order_id == orders.c.id)
+    bought = exists([1]).select_from(customer_lines).where(
+        and_(order_product.c.product_id == products.c.id,
+             orders.c.customer_id == customer_id))
+    bought_products = select([products]).distinct().\
+        select_from(customer_lines.join(
+            products, products.c.id == order_product.c.product_id)).\
+        where(orders.c.customer_id == customer_id)
+
+    latest = select([
+        orders,
+        func.row_number().over(
+            partition_by=orders.c.customer_id,
+            order_by=orders.c.init_time.desc()).label('position')
+    ]).where(orders.c.customer_id == customer_id).alias('latest')
+
+    return [
+        # 6. get all products for a current customer.
+        (6, 'join', bought_products),
+        (6, 'exists', select([products]).where(bought)),
+
+        # 8. get money amount that customer leaves for us:
+        (8, 'join',
+         select([func.sum(bought_products.alias('bought').c.price)])),
+        (8, 'exists', select([func.sum(products.c.price)]).where(bought)),
+
+        # 11. get the last customer order.
+        (11, 'window',
+         select([latest.c.id, latest.c.customer_id, latest.c.init_time,
+                 customers]).
+         select_from(latest.join(
+             customers, customers.c.id == latest.c.customer_id)).
+         where(latest.c.position == 1))
+    ]
+
+
+def db_latest_orders(tables):
+    # the last order of every customer.
+    customers = tables['customers']
+    orders = tables['orders']
+
+    previous = orders.alias('previous')
+    max_order_time = select([func.max(previous.c.init_time)]).\
+        where(previous.c.customer_id == orders.c.customer_id).as_scalar()
+
+    latest = select([
+        orders,
+        func.row_number().over(
+            partition_by=orders.c.customer_id,
+            order_by=orders.c.init_time.desc()).label('position')
+    ]).alias('latest')
+
+    return [
+        ('correlated',
+         select([orders, customers]).where(
+             and_(customers.c.id == orders.c.customer_id,
+                  orders.c.init_time == max_order_time))),
+        ('window',
+         select([latest.c.id, latest.c.customer_id, latest.c.init_time,
+                 customers]).
+         select_from(latest.join(
+             customers, customers.c.id == latest.c.customer_id)).
+         where(latest.c.position == 1))
+    ]
+
+
+def db_time_ranges(tables):
+    # orders of a customer and orders per day between begin (included)
+    # and end (excluded), on the (customer_id, init_time) and init_time
+    # indexes.
+    orders = tables['orders']
+    in_range = and_(orders.c.init_time >= bindparam('begin'),
+                    orders.c.init_time < bindparam('end'))
+    day = day_of(orders.c.init_time).label('day')
+
+    return {
+        'customer_orders':
+            select([orders]).\
+                where(and_(orders.c.customer_id == bindparam('customer_id'),
+                           in_range)).\
+                order_by(orders.c.init_time),
+        'orders_per_day':
+            select([day, func.count().label('orders')]).\
+                where(in_range).group_by(day).order_by(day)
+    }
+
+
+def db_listings(tables):
+    # the listings (1, 2, 3, 9) with the sort keys of their pages, the id
+    # comes last and makes the keys unique.
+    customers = tables['customers']
+    products = tables['products']
+    orders = tables['orders']
+
+    return {
+        'customers': (select([customers]), [customers.c.id]),
+        'orders': (select([orders]), [orders.c.init_time, orders.c.id]),
+        'products': (select([products]), [products.c.id]),
+        'customer_orders': (
+            select([customers, orders.c.id]).\
+                where(customers.c.id == orders.c.customer_id),
+            [customers.c.id, orders.c.id])
+    }
+
+
+def db_page(conn, select_expr, keys, cursor=None, limit=PAGE_SIZE):
+    # the page after the cursor, and the cursor of the next page (None
+    # after the last one).
+    if cursor is not None:
+        select_expr = select_expr.where(
+            after(keys, decode_cursor(cursor, keys)))
+    rows = conn.execute(
+        select_expr.order_by(None).order_by(*keys).limit(limit)).fetchall()
+
+    if len(rows) < limit:
+        return rows, None
+    return rows, encode_cursor([rows[-1][key] for key in keys])
+
+
+class QueryCatalog(object):
+    def __init__(self, tables, dialect):
+        self.statements = db_queries(tables)
+        self.compiled = [statement.compile(dialect=dialect)
+                         for statement in self.statements]
+
+    def execute(self, conn, number, **params):
+        # number is the query number from db_queries, starting with 1.
+        return conn.execute(self.compiled[number - 1], params)
+
+
+def db_stream(conn, select_expr, sink, batch_size=BATCH_SIZE):
+    conn = conn.execution_options(stream_results=True)
+    return stream(
+        fetch_batches(lambda: conn.execute(select_expr), batch_size), sink)
+
+
+def db_export(conn, select_expr, batch_size=None):
+    # numpy is only needed for the export.
+    from columnar import fetch_columns, EXPORT_SIZE
+
+    # by the Python type of the column, so a datetime is datetime64
+    # whether it is stored as text or as epoch microseconds.
+    dtypes = {int: 'int64', long: 'int64',
+              datetime.datetime: 'datetime64[us]'}
+    columns = []
+    epoch_columns = []
+    for column in select_expr.columns:
+        try:
+            dtype = dtypes.get(column.type.python_type, 'object')
+        except NotImplementedError:
+            dtype = 'object'
+        columns.append((column.key, dtype))
+        if is_epoch(column.type, conn.dialect):
+            epoch_columns.append(column.key)
+
+    # the rows are read from the DBAPI cursor, without a RowProxy and
+    # the conversions of the result in between.
+    result = conn.execute(select_expr)
+    try:
+        return fetch_columns(result.cursor, columns,
+                             batch_size or EXPORT_SIZE, epoch_columns)
+    finally:
+        result.close()
+
+
+def db_select(conn, tables):
+    def print_records(select_expr):
+        if db_stream(conn, select_expr, print_record)['rows'] == 0:
+            print 'No records.'
+            return
+
+        print
+
+    for select_expr in db_queries(tables):
+        print_records(select_expr)
+
+    # 6. or with the subqueries built one at a time.
+    products = tables['products']
+    orders = tables['orders']
+    order_product = tables['order_product']
+    order_ids = select([orders.c.id]).where(orders.c.customer_id == 2)
+    product_ids = select([order_product.c.product_id]).\
+                         where(order_product.c.order_id.in_(order_ids))
+    print_records(
+        select([products]).where(products.c.id.in_(product_ids)))
+
 if __name__ == '__main__':
     engine = create_engine('sqlite:///:memory:')
     conn = engine.connect()
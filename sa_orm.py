@@ -1,13 +1,29 @@
 from sqlalchemy import (
     create_engine,
-    Column, Integer, String, DateTime,
+    Column, Integer, String,
     Sequence, ForeignKey
 )
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, backref
+from sqlalchemy.orm import (
+    Session, sessionmaker, relationship, backref, configure_mappers,
+    aliased, lazyload, selectinload, joinedload, subqueryload, raiseload
+)
+from sqlalchemy.sql import func
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.selectable import SelectBase
 
+import collections
 import datetime
+import itertools
+import re
+import threading
+import weakref
+
+from datagen import chunks, CHUNK_SIZE
+from epoch import InitTime, use_epoch, day_of
+from pages import after, encode_cursor, decode_cursor, PAGE_SIZE
+from streaming import stream, print_record, BATCH_SIZE
 
 
 Base = declarative_base()
@@ -52,7 +68,7 @@ class Order(Base):
 
     id = Column(Integer, Sequence('order_id_seq'), primary_key=True)
     customer_id = Column(Integer, ForeignKey('customers.id'))
-    init_time = Column(DateTime, nullable=False)
+    init_time = Column(InitTime, nullable=False)
 
     customer = relationship('Customer', backref=backref('orders', order_by=id))
     products = relationship('Product', secondary='order_product', backref=backref('orders'))
@@ -61,9 +77,162 @@ class Order(Base):
         return '(%d, %d, %s)' % (self.id, self.customer_id, self.init_time)
 
 
-def db_create(Base):
+# parents before children, so foreign keys always point to loaded rows.
+LOAD_ORDER = [Customer, Product, Order, OrderProduct]
+
+
+def row_type(model):
+    # read-only stand-in for a model: the same name, columns and repr,
+    # but a plain tuple without instance state or a session behind it.
+    row = collections.namedtuple(model.__name__, model.__table__.c.keys())
+    row.__repr__ = model.__repr__.im_func
+    return row
+
+
+ROWS = dict((model, row_type(model)) for model in LOAD_ORDER)
+
+
+INDEXES = [
+    'CREATE INDEX orders_customer_id_init_time_idx ON orders (customer_id, init_time)',
+    'CREATE INDEX order_product_product_id_idx ON order_product (product_id, order_id)',
+    # pages of orders by (init_time, id).
+    'CREATE INDEX orders_init_time_idx ON orders (init_time)'
+]
+
+
+# loader options for the customer -> orders -> products graph. 'select'
+# is the default lazy loading, one SELECT per order; 'raise' refuses to
+# load the graph at all and catches code that would walk it lazily.
+LOADERS = {
+    'select': lazyload,
+    'selectin': selectinload,
+    'joined': joinedload,
+    'subquery': subqueryload,
+    'raise': raiseload
+}
+
+
+def load_options(strategy):
+    # Customer.orders is a backref and only exists once the mappers
+    # are configured.
+    configure_mappers()
+    loader = LOADERS[strategy]
+    return [loader(Customer.orders).options(loader(Order.products))]
+
+
+def use_epoch_time(engine):
+    # opt in to init_time as integer epoch microseconds on this engine
+    # only, before db_create and the first query on it. Other engines
+    # keep DATETIME text.
+    use_epoch(engine)
+
+
+# statements that only read, as text.
+READ = re.compile(r'\s*(?:SELECT|VALUES)\b', re.IGNORECASE)
+
+
+def is_read(clause):
+    if isinstance(clause, TextClause):
+        return READ.match(clause.text) is not None
+    return isinstance(clause, SelectBase)
+
+
+class ReplicaSet(object):
+    # the replica engines shared by the routing sessions. 'round-robin'
+    # takes them in turn, 'least-busy' takes the one with the fewest
+    # open session transactions. A holder that is garbage collected
+    # without releasing its replica gives it back as well.
+    def __init__(self, engines, policy='round-robin'):
+        self.engines = engines
+        self.policy = policy
+        # the collection of a holder can run on any thread, this one too.
+        self.lock = threading.RLock()
+        self.busy = dict((engine, 0) for engine in engines)
+        self.held = {}
+        self.turns = itertools.cycle(engines)
+
+    def acquire(self, holder):
+        with self.lock:
+            if self.policy == 'least-busy':
+                engine = min(self.engines, key=self.busy.get)
+            else:
+                engine = next(self.turns)
+            self.busy[engine] += 1
+            self.held[weakref.ref(holder, self.collected)] = engine
+            return engine
+
+    def release(self, holder):
+        self.collected(weakref.ref(holder))
+
+    def collected(self, ref):
+        with self.lock:
+            engine = self.held.pop(ref, None)
+            if engine is not None:
+                self.busy[engine] -= 1
+
+
+class RoutingSession(Session):
+    # flushes, bulk operations and every statement but a SELECT go to
+    # the primary, queries go to one replica for the whole transaction.
+    # With read_your_writes a session that has written reads from the
+    # primary from then on, the replicas may not have its rows yet.
+    def __init__(self, primary, replicas, read_your_writes=False, **kw):
+        Session.__init__(self, **kw)
+        self.primary = primary
+        self.replicas = replicas
+        self.read_your_writes = read_your_writes
+        self.wrote = False
+        self.replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        # the bulk_* methods ask for the bind of the mapper alone.
+        if self._flushing or not is_read(clause):
+            self.wrote = True
+            return self.primary
+        if self.read_your_writes and self.wrote:
+            return self.primary
+
+        if self.replica is None:
+            self.replica = self.replicas.acquire(self)
+        return self.replica
+
+    def release_replica(self):
+        if self.replica is not None:
+            self.replicas.release(self)
+            self.replica = None
+
+    def commit(self):
+        try:
+            Session.commit(self)
+        finally:
+            self.release_replica()
+
+    def rollback(self):
+        try:
+            Session.rollback(self)
+        finally:
+            self.release_replica()
+
+    def close(self):
+        try:
+            Session.close(self)
+        finally:
+            self.release_replica()
+            self.wrote = False
+
+
+def db_create(engine, indexed=False):
     Base.metadata.create_all(engine)
 
+    if indexed:
+        db_index(engine)
+
+
+def db_index(engine):
+    # kept out of the models so that the default schema stays as it is.
+    for text in INDEXES:
+        engine.execute(text)
+
 
 def db_insert(session):
     customers = [
@@ -122,98 +291,346 @@ def db_insert(session):
     session.add_all(order_products)
 
 
-def db_select(session):
-    def print_records(records):
-        if not records:
-            print 'No records.'
-            return
-
-        for record in records:
-            print record
-        print
+def db_load(session, data, chunk_size=CHUNK_SIZE):
+    inserted = 0
+    for model in LOAD_ORDER:
+        rows = data[model.__tablename__]
+        keys = model.__table__.c.keys()
+        for chunk in chunks(rows, chunk_size):
+            session.add_all(model(**dict(zip(keys, row))) for row in chunk)
+            session.flush()
+            # flushed objects are not needed any more, keep the
+            # identity map small.
+            session.expunge_all()
+            inserted += len(chunk)
+    return inserted
+
+
+def db_bulk_load(session, data, chunk_size=CHUNK_SIZE, core=True):
+    # no instances, identity map or unit of work: the rows go straight
+    # to an executemany, each chunk in its own transaction.
+    inserted = 0
+    for model in LOAD_ORDER:
+        rows = data[model.__tablename__]
+        keys = model.__table__.c.keys()
+        insert = model.__table__.insert()
+        for chunk in chunks(rows, chunk_size):
+            mappings = [dict(zip(keys, row)) for row in chunk]
+            if core:
+                session.execute(insert, mappings)
+            else:
+                session.bulk_insert_mappings(model, mappings)
+            session.commit()
+            inserted += len(chunk)
+    return inserted
+
+
+def db_queries(session):
+    queries = []
 
     # 1. get all customers.
-    print_records(
-        session.query(Customer).all())
+    queries.append(
+        session.query(Customer))
 
     # 2. get all orders.
-    print_records(
-        session.query(Order).all())
+    queries.append(
+        session.query(Order))
 
     # 3. get all products.
-    print_records(
-        session.query(Product).all())
+    queries.append(
+        session.query(Product))
 
     # 4. get all orders for a current customer.
-    print_records(
+    queries.append(
         session.query(Order).filter(Order.customer_id == 2))
 
-    # or
-    print_records(
-        session.query(Customer).filter_by(id=2).one().orders)
-
     # 5. get all products for a current order.
-    print_records(
+    queries.append(
         session.query(Product).filter(Product.id.in_(
             session.query(OrderProduct.product_id).filter_by(order_id=1))))
 
-    # or
-    print_records(
-        session.query(Order).filter_by(id=1).one().products)
-
     # 6. get all products for a current customer.
-    customer_2 = session.query(Customer).filter_by(id=2).one()
-    for order in customer_2.orders:
-        for product in order.products:
-            print product
-    print
-
-    # or
-    print_records(
-        session.query(Product).filter(Product.id.in_(
-            session.query(OrderProduct.product_id).filter(OrderProduct.order_id.in_(
-                session.query(Order.id).filter_by(customer_id=2))))))
-
-    # or
-    print_records(
+    queries.append(
         session.query(Product).join(OrderProduct).join(Order).join(Customer).\
-            filter(Customer.id == 2).order_by(Product.id).all())
+            filter(Customer.id == 2).order_by(Product.id))
 
     # 7. get count of our customers.
-    from sqlalchemy.sql import func
-    print_records(
+    queries.append(
         session.query(func.count(Customer.id)))
 
     # 8. get money amount that customer leaves for us:
-    print_records(
+    queries.append(
         session.query(func.sum(Product.price)).\
             join(OrderProduct).join(Order).join(Customer).\
                 filter(Customer.id == 2))
 
     # 9. get all customers with their orders if exists.
-    print_records(
+    queries.append(
         session.query(Customer, Order.id).join(Order).order_by(Customer.id))
 
     # 10. get all customers and their orders (and null if not exists).
-    print_records(
+    queries.append(
         session.query(Customer, Order.id).outerjoin(Order).order_by(Customer.id))
 
     # 11. get the last customer order.
     max_order_time = \
         session.query(func.max(Order.init_time)).\
             filter(Order.customer_id == 2)
-    print_records(
+    queries.append(
         session.query(Order, Customer).\
-            filter(Order.init_time == max_order_time,
+            filter(Order.customer_id == Customer.id,
+                   Order.init_time == max_order_time,
                    Customer.id == 2))
 
+    return queries
+
+
+def db_rewrites(session, customer_id=2):
+    # the nested IN queries (6, 8) and the correlated latest order (11)
+    # written with joins, EXISTS and ROW_NUMBER() instead. Query 8 above
+    # adds a product once per order line, these count every product once
+    # like query 8 of the other modules.
+    bought_products = session.query(Product).\
+        join(OrderProduct).join(Order).\
+            filter(Order.customer_id == customer_id).distinct()
+    bought = session.query(OrderProduct).join(Order).\
+        filter(OrderProduct.product_id == Product.id,
+               Order.customer_id == customer_id).exists()
+    bought_prices = session.query(Product.id, Product.price).\
+        join(OrderProduct).join(Order).\
+            filter(Order.customer_id == customer_id).distinct().subquery()
+
+    latest = session.query(
+        Order.id,
+        func.row_number().over(
+            partition_by=Order.customer_id,
+            order_by=Order.init_time.desc()).label('position')).\
+                filter(Order.customer_id == customer_id).subquery()
+
+    return [
+        # 6. get all products for a current customer.
+        (6, 'join', bought_products),
+        (6, 'exists', session.query(Product).filter(bought)),
+
+        # 8. get money amount that customer leaves for us:
+        (8, 'join', session.query(func.sum(bought_prices.c.price))),
+        (8, 'exists', session.query(func.sum(Product.price)).filter(bought)),
+
+        # 11. get the last customer order.
+        (11, 'window',
+         session.query(Order, Customer).\
+             join(latest, latest.c.id == Order.id).\
+             join(Customer, Customer.id == Order.customer_id).\
+                 filter(latest.c.position == 1))
+    ]
+
+
+def db_rewrite_baselines(session, customer_id=2):
+    # the rewrites of query 8 sum every product once, so they are
+    # compared with the IN form of the other modules and not with query
+    # 8 above.
+    bought_ids = session.query(OrderProduct.product_id).join(Order).\
+        filter(Order.customer_id == customer_id)
+    return {
+        8: session.query(func.sum(Product.price)).\
+            filter(Product.id.in_(bought_ids))
+    }
+
+
+def db_latest_orders(session):
+    # the last order of every customer.
+    previous = aliased(Order)
+    max_order_time = session.query(func.max(previous.init_time)).\
+        filter(previous.customer_id == Order.customer_id).as_scalar()
+
+    latest = session.query(
+        Order.id,
+        func.row_number().over(
+            partition_by=Order.customer_id,
+            order_by=Order.init_time.desc()).label('position')).subquery()
+
+    return [
+        ('correlated',
+         session.query(Order, Customer).\
+             filter(Order.customer_id == Customer.id,
+                    Order.init_time == max_order_time)),
+        ('window',
+         session.query(Order, Customer).\
+             join(latest, latest.c.id == Order.id).\
+             join(Customer, Customer.id == Order.customer_id).\
+                 filter(latest.c.position == 1))
+    ]
+
+
+def db_listings(session):
+    # the listings (1, 2, 3, 9) with the sort keys of their pages, the id
+    # comes last and makes the keys unique.
+    return {
+        'customers': (session.query(Customer), [Customer.id]),
+        'orders': (session.query(Order), [Order.init_time, Order.id]),
+        'products': (session.query(Product), [Product.id]),
+        'customer_orders': (
+            session.query(Customer, Order.id).join(Order),
+            [Customer.id, Order.id])
+    }
+
+
+def db_page(query, keys, cursor=None, limit=PAGE_SIZE):
+    # the page after the cursor, and the cursor of the next page (None
+    # after the last one). The keys are added to the rows to build the
+    # cursor and taken off again.
+    if cursor is not None:
+        query = query.filter(after(keys, decode_cursor(cursor, keys)))
+    width = len(query.column_descriptions)
+    rows = query.add_columns(*keys).\
+        order_by(None).order_by(*keys).limit(limit).all()
+
+    page = [row[0] if width == 1 else row[:width] for row in rows]
+    if len(rows) < limit:
+        return page, None
+    return page, encode_cursor(rows[-1][width:])
+
+
+def db_stream(query, sink, batch_size=BATCH_SIZE):
+    # yield_per hands out the instances in batches instead of
+    # building the whole list first.
+    return stream(chunks(query.yield_per(batch_size), batch_size), sink)
+
+
+def unique_rows(result, make, n_keys):
+    # the primary key columns come first in every table.
+    seen = set()
+    for row in result:
+        key = row[0] if n_keys == 1 else tuple(row[:n_keys])
+        if key not in seen:
+            seen.add(key)
+            yield make(row)
+
+
+def entity_row(model):
+    # an entity of an outer join without a match is None, like in the
+    # ORM, not a row of None columns.
+    make = ROWS[model]._make
+    keys = [i for i, column in enumerate(model.__table__.c)
+            if column.primary_key]
+
+    def build(values):
+        if all(values[i] is None for i in keys):
+            return None
+        return make(values)
+    return build
+
+
+def db_rows(query):
+    # the entities of the query are replaced by their columns and every
+    # row is built straight from the column tuple, no identity map or
+    # attribute instrumentation is involved.
+    layout = []
+    columns = []
+    for description in query.column_descriptions:
+        expr = description['expr']
+        if isinstance(expr, type) and expr in ROWS:
+            layout.append((entity_row(expr), len(columns)))
+            columns.extend(expr.__table__.c)
+        else:
+            layout.append((None, len(columns)))
+            columns.append(expr)
+    ends = [start for _, start in layout[1:]] + [len(columns)]
+
+    statement = query.with_entities(*columns).statement
+    result = query.session.execute(statement)
+
+    if len(layout) == 1 and layout[0][0] is not None:
+        # like the ORM, a query for a single entity returns every
+        # instance once, even if a join repeats it.
+        model = query.column_descriptions[0]['expr']
+        return unique_rows(result, layout[0][0],
+                           len(model.__table__.primary_key))
+
+    return (tuple(make(row[start:end]) if make else row[start]
+                  for (make, start), end in zip(layout, ends))
+            for row in (tuple(row) for row in result))
+
+
+def db_customer_products(session, customer_id, strategy='selectin'):
+    customer = session.query(Customer).\
+        options(*load_options(strategy)).filter_by(id=customer_id).one()
+    return [product
+            for order in customer.orders
+            for product in order.products]
+
+
+def db_customer_orders(session, customer_id):
+    return session.query(Order).filter(Order.customer_id == customer_id).all()
+
+
+def db_customer_orders_between(session, customer_id, begin, end):
+    # begin is included, end is not.
+    return session.query(Order).\
+        filter(Order.customer_id == customer_id,
+               Order.init_time >= begin,
+               Order.init_time < end).\
+        order_by(Order.init_time).all()
+
+
+def db_orders_per_day(session, begin, end):
+    day = day_of(Order.init_time).label('day')
+    return session.query(day, func.count(Order.id)).\
+        filter(Order.init_time >= begin, Order.init_time < end).\
+        group_by(day).order_by(day).all()
+
+
+def db_customer_spend(session, customer_id):
+    return session.query(func.sum(Product.price)).\
+        join(OrderProduct).join(Order).\
+            filter(Order.customer_id == customer_id).scalar()
+
+
+def db_select(session):
+    def print_records(records):
+        if not records:
+            print 'No records.'
+            return
+
+        for record in records:
+            print record
+        print
+
+    for query in db_queries(session):
+        if db_stream(query, print_record)['rows'] == 0:
+            print 'No records.'
+        else:
+            print
+
+    # 4. the same through the relationship.
+    print_records(
+        session.query(Customer).filter_by(id=2).one().orders)
+
+    # 5. the same through the relationship.
+    print_records(
+        session.query(Order).filter_by(id=1).one().products)
+
+    # 6. the same by walking the relationships.
+    customer_2 = session.query(Customer).\
+        options(*load_options('selectin')).filter_by(id=2).one()
+    for order in customer_2.orders:
+        for product in order.products:
+            print product
+    print
+
+    # or with nested subqueries.
+    print_records(
+        session.query(Product).filter(Product.id.in_(
+            session.query(OrderProduct.product_id).filter(OrderProduct.order_id.in_(
+                session.query(Order.id).filter_by(customer_id=2))))))
+
 
 if __name__ == '__main__':
     engine = create_engine('sqlite:///:memory:')
     Session = sessionmaker(bind=engine)
     session = Session()
 
-    db_create(Base)
+    db_create(engine)
     db_insert(session)
     db_select(session)
 
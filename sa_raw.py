@@ -1,8 +1,170 @@
 from sqlalchemy import create_engine
 import datetime
 
+from datagen import chunks, CHUNK_SIZE
+from streaming import (
+    stream, fetch_batches, print_record, BATCH_SIZE
+)
 
-def db_create(conn):
+
+QUERIES = [
+    # 1. get all customers.
+    'SELECT * FROM customers',
+
+    # 2. get all orders.
+    'SELECT * FROM orders',
+
+    # 3. get all products.
+    'SELECT * FROM products',
+
+    # 4. get all orders for a current customer.
+    'SELECT * FROM orders WHERE customer_id = 2',
+
+    # 5. get all products for a current order.
+    '''
+    SELECT * FROM products WHERE id IN
+      (SELECT product_id FROM order_product
+         WHERE order_id = 1)
+    ''',
+
+    # 6. get all products for a current customer.
+    '''
+    SELECT * FROM products WHERE id IN
+      (SELECT product_id FROM order_product WHERE order_id IN
+           (SELECT id FROM orders WHERE customer_id = 2))
+    ''',
+
+    # 7. get count of our customers.
+    'SELECT count(*) from customers',
+
+    # 8. get money amount that customer leaves for us:
+    '''
+    SELECT sum(price) FROM products WHERE id IN
+      (SELECT product_id FROM order_product WHERE order_id IN
+         (SELECT id FROM orders WHERE customer_id = 2))
+    ''',
+
+    # 9. get all customers with their orders if exists.
+    '''
+    SELECT customers.id,
+           customers.name,
+           customers.surname,
+           orders.id
+      FROM customers, orders
+        WHERE customers.id = orders.customer_id
+    ''',
+
+    # 10. get all customers and their orders (and null if not exists).
+    '''
+    SELECT customers.id,
+           customers.name,
+           customers.surname,
+           orders.id
+      FROM customers
+        LEFT JOIN orders
+          ON customers.id = orders.customer_id
+    ''',
+
+    # 11. get the last customer order.
+    '''
+    SELECT * FROM orders, customers
+      WHERE customers.id = orders.customer_id
+        AND customer_id = 2
+        AND orders.init_time =
+         (SELECT max(init_time) FROM orders
+            WHERE customer_id = 2)
+    '''
+]
+
+
+# the nested IN queries (6, 8) and the correlated latest order (11)
+# written with joins, EXISTS and ROW_NUMBER() instead.
+REWRITES = [
+    # 6. get all products for a current customer.
+    (6, 'join', '''
+    SELECT DISTINCT products.*
+      FROM orders
+        JOIN order_product ON order_product.order_id = orders.id
+        JOIN products ON products.id = order_product.product_id
+      WHERE orders.customer_id = 2
+    '''),
+
+    (6, 'exists', '''
+    SELECT * FROM products WHERE EXISTS
+      (SELECT 1 FROM order_product
+         JOIN orders ON orders.id = order_product.order_id
+           WHERE order_product.product_id = products.id
+             AND orders.customer_id = 2)
+    '''),
+
+    # 8. get money amount that customer leaves for us:
+    (8, 'join', '''
+    SELECT sum(price) FROM
+      (SELECT DISTINCT products.id, products.price
+         FROM orders
+           JOIN order_product ON order_product.order_id = orders.id
+           JOIN products ON products.id = order_product.product_id
+         WHERE orders.customer_id = 2)
+    '''),
+
+    (8, 'exists', '''
+    SELECT sum(price) FROM products WHERE EXISTS
+      (SELECT 1 FROM order_product
+         JOIN orders ON orders.id = order_product.order_id
+           WHERE order_product.product_id = products.id
+             AND orders.customer_id = 2)
+    '''),
+
+    # 11. get the last customer order.
+    (11, 'window', '''
+    SELECT latest.id, latest.customer_id, latest.init_time, customers.*
+      FROM (SELECT orders.*,
+                   ROW_NUMBER() OVER (PARTITION BY customer_id
+                                      ORDER BY init_time DESC) AS position
+              FROM orders WHERE customer_id = 2) latest
+        JOIN customers ON customers.id = latest.customer_id
+      WHERE latest.position = 1
+    ''')
+]
+
+
+# the last order of every customer.
+LATEST_ORDERS = [
+    ('correlated', '''
+    SELECT * FROM orders, customers
+      WHERE customers.id = orders.customer_id
+        AND orders.init_time =
+         (SELECT max(init_time) FROM orders AS latest
+            WHERE latest.customer_id = orders.customer_id)
+    '''),
+
+    ('window', '''
+    SELECT latest.id, latest.customer_id, latest.init_time, customers.*
+      FROM (SELECT orders.*,
+                   ROW_NUMBER() OVER (PARTITION BY customer_id
+                                      ORDER BY init_time DESC) AS position
+              FROM orders) latest
+        JOIN customers ON customers.id = latest.customer_id
+      WHERE latest.position = 1
+    ''')
+]
+
+
+INDEXES = [
+    # SQLite can't add a primary key to an existing table, unique indexes
+    # give the same lookup paths.
+    'CREATE UNIQUE INDEX customers_pk ON customers (id)',
+    'CREATE UNIQUE INDEX products_pk ON products (id)',
+    'CREATE UNIQUE INDEX orders_pk ON orders (id)',
+    'CREATE UNIQUE INDEX order_product_pk ON order_product (order_id, product_id)',
+
+    # covering indexes for the per-customer and per-product lookups.
+    'CREATE INDEX orders_customer_id_init_time_idx ON orders (customer_id, init_time, id)',
+    'CREATE INDEX order_product_product_id_idx ON order_product (product_id, order_id)'
+]
+
+
+def db_create(conn, indexed=False):
     conn.execute('''CREATE TABLE CUSTOMERS (
 ID NUMBER(32) NOT NULL,
 NAME VARCHAR2(20) NOT NULL,
@@ -27,6 +189,14 @@ CUSTOMER_ID NUMBER(32) NOT NULL,
 INIT_TIME DATETIME NOT NULL
     );''')
 
+    if indexed:
+        db_index(conn)
+
+
+def db_index(conn):
+    for text in INDEXES:
+        conn.execute(text)
+
 
 def db_insert(conn):
     customers = [
@@ -93,94 +263,37 @@ def db_insert(conn):
         order_product)
 
 
+def db_load(conn, data, chunk_size=CHUNK_SIZE):
+    inserted = 0
+    for table, placeholders in (
+            ('customers', ':id, :name, :surname, :email'),
+            ('products', ':id, :name, :price'),
+            ('orders', ':id, :customer_id, :init_time'),
+            ('order_product', ':order_id, :product_id')):
+        for chunk in chunks(data[table], chunk_size):
+            conn.execute(
+                'INSERT INTO %s VALUES (%s)' % (table, placeholders),
+                chunk)
+            inserted += len(chunk)
+    return inserted
+
+
+def db_stream(conn, text, sink, batch_size=BATCH_SIZE):
+    conn = conn.execution_options(stream_results=True)
+    return stream(
+        fetch_batches(lambda: conn.execute(text), batch_size), sink)
+
+
 def db_select(conn):
     def select_and_print(text):
-        records = conn.execute(text)
-
-        if records.rowcount == 0:
+        if db_stream(conn, text, print_record)['rows'] == 0:
             print 'No records.'
             return
 
-        for record in records:
-            print record
         print
 
-    # 1. get all customers.
-    select_and_print(
-        'SELECT * FROM customers')
-
-    # 2. get all orders.
-    select_and_print(
-        'SELECT * FROM orders')
-
-    # 3. get all products.
-    select_and_print(
-        'SELECT * FROM products')
-
-    # 4. get all orders for a current customer.
-    select_and_print(
-        'SELECT * FROM orders WHERE customer_id = 2')
-
-    # 5. get all products for a current order.
-    select_and_print(
-        '''
-        SELECT * FROM products WHERE id IN
-          (SELECT product_id FROM order_product
-             WHERE order_id = 1)
-        ''')
-
-    # 6. get all products for a current customer.
-    select_and_print(
-        '''
-        SELECT * FROM products WHERE id IN
-          (SELECT product_id FROM order_product WHERE order_id IN
-               (SELECT id FROM orders WHERE customer_id = 2))
-        ''')
-
-    # 7. get count of our customers.
-    select_and_print('SELECT count(*) from customers')
-
-    # 8. get money amount that customer leaves for us:
-    select_and_print(
-        '''
-        SELECT sum(price) FROM products WHERE id IN
-          (SELECT product_id FROM order_product WHERE order_id IN
-             (SELECT id FROM orders WHERE customer_id = 2))
-        ''')
-
-    # 9. get all customers with their orders if exists.
-    select_and_print(
-        '''
-        SELECT customers.id,
-               customers.name,
-               customers.surname,
-               orders.id
-          FROM customers, orders
-            WHERE customers.id = orders.customer_id
-        ''')
-
-    # 10. get all customers and their orders (and null if not exists).
-    select_and_print(
-        '''
-        SELECT customers.id,
-               customers.name,
-               customers.surname,
-               orders.id
-          FROM customers
-            LEFT JOIN orders
-              ON customers.id = orders.customer_id
-        ''')
-
-    # 11. get the last customer order.
-    select_and_print(
-        '''
-        SELECT * FROM orders, customers
-          WHERE customers.id = orders.customer_id
-            AND customer_id = 2
-            AND orders.init_time =
-             (SELECT max(init_time) FROM orders
-                WHERE customer_id = 2)
-        ''')
+    for text in QUERIES:
+        select_and_print(text)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,134 @@
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import timeit
+
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import create_engine, MetaData
+from sqlalchemy.pool import QueuePool
+
+import datagen
+import sa_expressions
+from benchmark import percentile
+from lookups import create_database
+from profiles import use_profile
+
+
+def make_engine(path, pool_size=5, max_overflow=10, pool_timeout=30,
+                pre_ping=False):
+    engine = create_engine(
+        'sqlite:///' + path,
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_pre_ping=pre_ping,
+        # pooled connections move between the worker threads.
+        connect_args={'check_same_thread': False})
+    # WAL lets the readers run next to each other and next to a writer.
+    return use_profile(engine, 'read-heavy')
+
+
+class Server(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.waits = []
+        self.workers = {}
+
+        tables = sa_expressions.db_create(None, MetaData())
+        self.catalog = sa_expressions.QueryCatalog(tables, engine.dialect)
+
+    def __call__(self, request):
+        number, customer_id, order_id = request
+        begin = timeit.default_timer()
+
+        conn = self.engine.connect()
+        checked_out = timeit.default_timer()
+        try:
+            rows = len(self.catalog.execute(
+                conn, number,
+                customer_id=customer_id, order_id=order_id).fetchall())
+        finally:
+            conn.close()
+        finished = timeit.default_timer()
+
+        worker = threading.current_thread().name
+        with self.lock:
+            self.waits.append(checked_out - begin)
+            stats = self.workers.setdefault(
+                worker, {'requests': 0, 'busy': 0.0})
+            stats['requests'] += 1
+            stats['busy'] += finished - begin
+        return rows
+
+
+def make_requests(n_requests, n_orders, seed=0):
+    rnd = random.Random(seed)
+    n_customers, _ = datagen.sizes(n_orders)
+    return [(rnd.randint(1, 11),
+             rnd.randint(1, n_customers),
+             rnd.randint(1, n_orders))
+            for _ in xrange(n_requests)]
+
+
+def serve(engine, requests, workers):
+    server = Server(engine)
+    pool = ThreadPool(workers)
+
+    begin = timeit.default_timer()
+    pool.map(server, requests, chunksize=1)
+    elapsed = timeit.default_timer() - begin
+
+    pool.close()
+    pool.join()
+    return server, elapsed
+
+
+def print_report(workers, pool_size, server, elapsed):
+    print '%d workers, pool size %d: %d requests in %.3fs (%d/s)' % (
+        workers, pool_size, len(server.waits), elapsed,
+        len(server.waits) / elapsed)
+    print '  pool wait: mean %.3fms, p95 %.3fms, max %.3fms' % (
+        sum(server.waits) / len(server.waits) * 1000,
+        percentile(server.waits, 95) * 1000,
+        max(server.waits) * 1000)
+    for worker, stats in sorted(server.workers.items()):
+        print '  %s: %d requests, %d/s while busy' % (
+            worker, stats['requests'],
+            stats['requests'] / max(stats['busy'], 1e-9))
+    print
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve the reference queries from a thread pool.')
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[8])
+    parser.add_argument('--pool-size', type=int, nargs='+', default=[2, 8])
+    parser.add_argument('--max-overflow', type=int, default=0)
+    parser.add_argument('--pool-timeout', type=float, default=30)
+    parser.add_argument('--pre-ping', action='store_true')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'serve.db')
+    try:
+        create_database(path, args.orders)
+        requests = make_requests(args.requests, args.orders)
+
+        for workers in args.workers:
+            for pool_size in args.pool_size:
+                engine = make_engine(
+                    path, pool_size, args.max_overflow,
+                    args.pool_timeout, args.pre_ping)
+                server, elapsed = serve(engine, requests, workers)
+                print_report(workers, pool_size, server, elapsed)
+                engine.dispose()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,312 @@
+import argparse
+import datetime
+import heapq
+import itertools
+import os
+import shutil
+import tempfile
+import timeit
+
+from multiprocessing import Pool
+
+from sqlalchemy import create_engine, MetaData
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import object_session, sessionmaker
+from sqlalchemy.sql import visitors, operators
+from sqlalchemy.sql.elements import BindParameter
+from sqlalchemy.sql.util import find_tables
+
+import datagen
+import sa_expressions
+import sa_orm
+
+
+# orders and order_product are split over the shards by customer_id,
+# customers and products are copied to every shard. Every shard is a
+# SQLite file with the indexed schema of sa_expressions.
+
+SHARDED = ('orders', 'order_product')
+REPLICATED = ('customers', 'products')
+
+# queries by the number of db_queries: the replicated tables are read
+# from the first shard, the orders of one customer live on its shard,
+# everything else is asked from all shards and merged.
+FIRST_SHARD = [1, 3, 7]
+CUSTOMER_SHARD = [4, 6, 8, 11]
+
+
+def shard_of(customer_id, n_shards):
+    return customer_id % n_shards
+
+
+def create_shards(paths, data, chunk_size=datagen.CHUNK_SIZE):
+    metadata = MetaData()
+    tables = sa_expressions.db_create(None, metadata, indexed=True)
+    engines = [create_engine('sqlite:///' + path) for path in paths]
+    conns = []
+    for engine in engines:
+        metadata.create_all(engine)
+        conns.append(engine.connect())
+    transactions = [conn.begin() for conn in conns]
+
+    def insert(name, parts):
+        keys = tables[name].c.keys()
+        for conn, rows in zip(conns, parts):
+            if rows:
+                conn.execute(tables[name].insert(),
+                             [dict(zip(keys, row)) for row in rows])
+
+    for name in REPLICATED:
+        for chunk in datagen.chunks(data[name], chunk_size):
+            insert(name, [chunk] * len(conns))
+
+    # order_product rows go to the shard of their order. Both tables come
+    # sorted by order id, so the order_product rows of a chunk of orders
+    # are the ones that follow the previous chunk, and only the shards of
+    # the orders of one chunk are kept.
+    order_products = iter(data['order_product'])
+    pending = next(order_products, None)
+    for chunk in datagen.chunks(data['orders'], chunk_size):
+        order_shards = {}
+        parts = [[] for _ in conns]
+        for row in chunk:
+            shard = order_shards[row[0]] = shard_of(row[1], len(conns))
+            parts[shard].append(row)
+        insert('orders', parts)
+
+        parts = [[] for _ in conns]
+        while pending is not None and pending[0] <= chunk[-1][0]:
+            if pending[0] not in order_shards:
+                raise ValueError('order_product row %r is out of order or '
+                                 'has no order' % (pending,))
+            parts[order_shards[pending[0]]].append(pending)
+            pending = next(order_products, None)
+        insert('order_product', parts)
+
+    if pending is not None:
+        raise ValueError('order_product row %r has no order' % (pending,))
+
+    for transaction, conn, engine in zip(transactions, conns, engines):
+        transaction.commit()
+        conn.close()
+        engine.dispose()
+
+
+# connections of a pool worker, one to every shard.
+worker = {}
+
+
+def open_shards(paths):
+    tables = sa_expressions.db_create(None, MetaData())
+    engines = [create_engine('sqlite:///' + path) for path in paths]
+    worker['conns'] = [engine.connect() for engine in engines]
+    worker['catalog'] = sa_expressions.QueryCatalog(
+        tables, engines[0].dialect)
+
+
+def run_on_shard(task):
+    shard, number, params = task
+    result = worker['catalog'].execute(
+        worker['conns'][shard], number, **params)
+    # plain tuples go back to the parent process.
+    return [tuple(row) for row in result]
+
+
+def merge_sorted(parts):
+    return list(heapq.merge(*[sorted(part) for part in parts]))
+
+
+def merge_outer(parts):
+    # a customer comes back with a NULL order from every shard that has
+    # none of its orders, the NULL only stays if no shard has any.
+    rows = []
+    for customer, group in itertools.groupby(merge_sorted(parts),
+                                             key=lambda row: row[:-1]):
+        orders = [row for row in group if row[-1] is not None]
+        rows.extend(orders or [customer + (None,)])
+    return rows
+
+
+MERGES = {
+    10: merge_outer
+}
+
+
+class ShardRouter(object):
+    def __init__(self, paths, processes=None):
+        self.n_shards = len(paths)
+        self.pool = Pool(processes or self.n_shards, open_shards, (paths,))
+
+    def shards(self, number, customer_id):
+        if number in FIRST_SHARD:
+            return [0]
+        if number in CUSTOMER_SHARD:
+            return [shard_of(customer_id, self.n_shards)]
+        return range(self.n_shards)
+
+    def execute(self, number, customer_id=2, order_id=1):
+        params = {'customer_id': customer_id, 'order_id': order_id}
+        shards = self.shards(number, customer_id)
+        parts = self.pool.map(
+            run_on_shard, [(shard, number, params) for shard in shards],
+            chunksize=1)
+        if len(parts) == 1:
+            return parts[0]
+        return MERGES.get(number, merge_sorted)(parts)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def customer_ids(statement):
+    # the customer ids the statement compares orders.customer_id or
+    # customers.id with.
+    ids = set()
+
+    def visit_binary(binary):
+        if binary.operator is not operators.eq:
+            return
+        for column, value in ((binary.left, binary.right),
+                              (binary.right, binary.left)):
+            table = getattr(column, 'table', None)
+            if table is None or not isinstance(value, BindParameter):
+                continue
+            if (table.name, column.name) in (('orders', 'customer_id'),
+                                             ('customers', 'id')):
+                ids.add(value.effective_value)
+
+    visitors.traverse(statement, {}, {'binary': visit_binary})
+    return ids
+
+
+def make_session(paths):
+    # the ORM models over the shards. The ShardedSession asks the chosen
+    # shards one after another and concatenates the results.
+    n_shards = len(paths)
+    shards = dict((str(i), create_engine('sqlite:///' + path))
+                  for i, path in enumerate(paths))
+
+    def shard_chooser(mapper, instance, clause=None):
+        if isinstance(instance, sa_orm.OrderProduct):
+            # the shard of its order: an order added to the session, or
+            # else the order asked from the shards.
+            order_id = instance.order_id
+            session = object_session(instance)
+            orders = [order for order in session.new
+                      if isinstance(order, sa_orm.Order) and
+                      order.id == order_id]
+            with session.no_autoflush:
+                instance = orders[0] if orders else \
+                    session.query(sa_orm.Order).get(order_id)
+            if instance is None:
+                raise ValueError('order %d is on none of the shards' %
+                                 order_id)
+        if isinstance(instance, sa_orm.Order):
+            return str(shard_of(instance.customer_id, n_shards))
+        if instance is not None:
+            raise ValueError('%s rows are written with create_shards' %
+                             mapper.class_.__name__)
+        return '0'
+
+    def id_chooser(query, ident):
+        if query.column_descriptions[0]['type'] in (sa_orm.Customer,
+                                                    sa_orm.Product):
+            return ['0']
+        return sorted(shards)
+
+    def query_chooser(query):
+        statement = query.statement
+        tables = set(table.name for table in
+                     find_tables(statement, include_crud=True))
+        if not tables & set(SHARDED):
+            return ['0']
+
+        ids = customer_ids(statement)
+        if ids:
+            return sorted(set(str(shard_of(customer_id, n_shards))
+                              for customer_id in ids))
+        return sorted(shards)
+
+    Session = sessionmaker(class_=ShardedSession)
+    return Session(shards=shards,
+                   shard_chooser=shard_chooser,
+                   id_chooser=id_chooser,
+                   query_chooser=query_chooser)
+
+
+if __name__ == '__main__':
+    from lookups import create_database
+
+    parser = argparse.ArgumentParser(
+        description='Compare the queries on one database and on shards.')
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--customer', type=int, default=2)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'single.db')
+        paths = [os.path.join(directory, 'shard%d.db' % i)
+                 for i in xrange(args.shards)]
+        create_database(path, args.orders)
+        create_shards(paths, datagen.generate(args.orders))
+
+        engine = create_engine('sqlite:///' + path)
+        conn = engine.connect()
+        catalog = sa_expressions.QueryCatalog(
+            sa_expressions.db_create(None, MetaData()), engine.dialect)
+        router = ShardRouter(paths)
+
+        print '%5s %8s %10s %12s %10s' % (
+            'query', 'rows', 'single ms', 'shards', 'sharded ms')
+        for number in xrange(1, 12):
+            begin = timeit.default_timer()
+            expected = catalog.execute(
+                conn, number, customer_id=args.customer, order_id=1).\
+                fetchall()
+            single = timeit.default_timer() - begin
+
+            begin = timeit.default_timer()
+            rows = router.execute(number, customer_id=args.customer)
+            sharded = timeit.default_timer() - begin
+
+            assert sorted(rows) == sorted(tuple(row) for row in expected)
+            print '%5d %8d %10.3f %12d %10.3f' % (
+                number, len(rows), single * 1000,
+                len(router.shards(number, args.customer)), sharded * 1000)
+
+        router.close()
+        conn.close()
+        engine.dispose()
+
+        # 4. and 8. through the ORM.
+        session = make_session(paths)
+        orders = sa_orm.db_customer_orders(session, args.customer)
+        spend = sa_orm.db_customer_spend(session, args.customer)
+        print 'orm: customer %d has %d orders, spend %s' % (
+            args.customer, len(orders), spend)
+
+        # a new order and its products, the second added with the order
+        # no longer in the session, all land on the shard of the customer.
+        order_id = args.orders + 1
+        session.add(sa_orm.Order(id=order_id, customer_id=args.customer,
+                                 init_time=datetime.datetime.now()))
+        session.add(sa_orm.OrderProduct(order_id=order_id, product_id=1))
+        session.commit()
+        session.expunge_all()
+        session.add(sa_orm.OrderProduct(order_id=order_id, product_id=2))
+        session.commit()
+        session.close()
+
+        for i, path in enumerate(paths):
+            engine = create_engine('sqlite:///' + path)
+            rows = engine.execute(
+                'SELECT count(*) FROM order_product WHERE order_id = ?',
+                order_id).scalar()
+            assert rows == (2 if i == shard_of(args.customer, len(paths))
+                            else 0)
+            engine.dispose()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,159 @@
+import argparse
+import sqlite3
+import timeit
+
+import datagen
+import sqlite
+
+
+# Summary of query 8 (money amount that customer leaves for us) kept up
+# to date by a trigger on order_product. Like query 8 it sums the prices
+# of the distinct products a customer bought, so customer_products keeps
+# the pairs already counted and a product only adds to the spend the
+# first time the customer orders it. The trigger looks orders up by id,
+# create the tables with indexed=True before adding it.
+#
+# All functions take a sqlite3 cursor or a SQLAlchemy connection, both
+# run plain SQL with '?' parameters.
+
+SPEND_DDL = [
+    '''
+    CREATE TABLE customer_spend (
+        customer_id INTEGER NOT NULL PRIMARY KEY,
+        spend INTEGER NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE customer_products (
+        customer_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        PRIMARY KEY (customer_id, product_id)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TRIGGER customer_spend_insert AFTER INSERT ON order_product
+    BEGIN
+        INSERT OR IGNORE INTO customer_spend (customer_id, spend)
+            SELECT customer_id, 0 FROM orders WHERE id = NEW.order_id;
+
+        UPDATE customer_spend
+           SET spend = spend +
+               (SELECT price FROM products WHERE id = NEW.product_id)
+         WHERE customer_id =
+               (SELECT customer_id FROM orders WHERE id = NEW.order_id)
+           AND NOT EXISTS
+               (SELECT 1 FROM customer_products
+                  WHERE customer_products.customer_id =
+                        customer_spend.customer_id
+                    AND customer_products.product_id = NEW.product_id);
+
+        INSERT OR IGNORE INTO customer_products (customer_id, product_id)
+            SELECT customer_id, NEW.product_id
+              FROM orders WHERE id = NEW.order_id;
+    END
+    '''
+]
+
+BOUGHT = '''
+    SELECT DISTINCT orders.customer_id, order_product.product_id
+      FROM orders, order_product
+        WHERE orders.id = order_product.order_id
+'''
+
+RECOMPUTE = '''
+    SELECT bought.customer_id, sum(products.price)
+      FROM (%s) bought,
+           products
+        WHERE products.id = bought.product_id
+          GROUP BY bought.customer_id
+''' % BOUGHT
+
+
+def db_create(conn):
+    for text in SPEND_DDL:
+        conn.execute(text)
+
+    # rows that are already there don't go through the trigger.
+    conn.execute('INSERT INTO customer_products (customer_id, product_id) ' +
+                 BOUGHT)
+    conn.execute('INSERT INTO customer_spend (customer_id, spend) ' +
+                 RECOMPUTE)
+
+
+def db_spend(conn, customer_id):
+    row = conn.execute(
+        'SELECT spend FROM customer_spend WHERE customer_id = ?',
+        (customer_id,)).fetchone()
+    return row[0] if row is not None else None
+
+
+def db_check(conn):
+    summary = dict(conn.execute(
+        'SELECT customer_id, spend FROM customer_spend WHERE spend != 0').
+        fetchall())
+    recomputed = dict(conn.execute(RECOMPUTE).fetchall())
+
+    return [(customer_id,
+             summary.get(customer_id),
+             recomputed.get(customer_id))
+            for customer_id in sorted(set(summary) | set(recomputed))
+            if summary.get(customer_id) != recomputed.get(customer_id)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare query 8 with the customer_spend summary.')
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--customer', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=100)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(':memory:')
+    curr = conn.cursor()
+    sqlite.db_create(curr, indexed=True)
+
+    # the first half is backfilled, the second half goes through the
+    # trigger.
+    n_customers, n_products = datagen.sizes(args.orders)
+    half = args.orders // 2
+    curr.executemany('INSERT INTO customers VALUES (?, ?, ?, ?)',
+                     datagen.customers(n_customers))
+    curr.executemany('INSERT INTO products VALUES (?, ?, ?)',
+                     datagen.products(n_products))
+    curr.executemany('INSERT INTO orders VALUES (?, ?, ?)',
+                     datagen.orders(args.orders, n_customers))
+    order_product = list(datagen.order_product(args.orders, n_products))
+    split = next(i for i, row in enumerate(order_product) if row[0] > half)
+    curr.executemany('INSERT INTO order_product VALUES (?, ?)',
+                     order_product[:split])
+
+    db_create(curr)
+
+    begin = timeit.default_timer()
+    curr.executemany('INSERT INTO order_product VALUES (?, ?)',
+                     order_product[split:])
+    print 'trigger insert: %d rows in %.3fs' % (
+        len(order_product) - split, timeit.default_timer() - begin)
+
+    query_8 = sqlite.QUERIES[7].replace(
+        'customer_id = 2', 'customer_id = %d' % args.customer)
+
+    begin = timeit.default_timer()
+    for _ in xrange(args.repeat):
+        full = curr.execute(query_8).fetchone()[0]
+    print 'query 8:    %s in %.3fms' % (
+        full, (timeit.default_timer() - begin) / args.repeat * 1000)
+
+    begin = timeit.default_timer()
+    for _ in xrange(args.repeat):
+        fast = db_spend(curr, args.customer)
+    print 'fast path:  %s in %.3fms' % (
+        fast, (timeit.default_timer() - begin) / args.repeat * 1000)
+
+    mismatches = db_check(curr)
+    print 'consistency check: %d mismatching customers' % len(mismatches)
+    for customer_id, summary, recomputed in mismatches[:10]:
+        print '  customer %d: summary %s, recomputed %s' % (
+            customer_id, summary, recomputed)
+
+    conn.close()
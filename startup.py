@@ -0,0 +1,91 @@
+import argparse
+import json
+import subprocess
+import sys
+
+
+# Every run starts a new interpreter, imports are only slow the first
+# time. The phases are timed one after another inside the child.
+
+EAGER = '''
+import timeit
+begin = timeit.default_timer()
+import sqlalchemy, sqlalchemy.orm, sqlalchemy.ext.declarative
+imported_sqlalchemy = timeit.default_timer()
+import sa_orm
+imported = timeit.default_timer()
+sa_orm.configure_mappers()
+configured = timeit.default_timer()
+engine = sa_orm.create_engine('sqlite:///:memory:')
+sa_orm.db_create(engine)
+created = timeit.default_timer()
+session = sa_orm.sessionmaker(bind=engine)()
+session.query(sa_orm.Customer).all()
+queried = timeit.default_timer()
+phases = [
+    ('import sqlalchemy', imported_sqlalchemy - begin),
+    ('import sa_orm', imported - imported_sqlalchemy),
+    ('configure mappers', configured - imported),
+    ('create_all', created - configured),
+    ('first query', queried - created)]
+'''
+
+LAZY = '''
+import timeit
+begin = timeit.default_timer()
+import lazy_orm
+imported = timeit.default_timer()
+session = lazy_orm.session(['Customer'])
+created = timeit.default_timer()
+Customer, = lazy_orm.models('Customer')
+session.query(Customer).all()
+queried = timeit.default_timer()
+phases = [
+    ('import lazy_orm', imported - begin),
+    ('session(Customer)', created - imported),
+    ('first query', queried - created)]
+'''
+
+# the sqlite module doesn't need SQLAlchemy at all.
+SQLITE_ONLY = '''
+import timeit
+begin = timeit.default_timer()
+import lazy_orm
+import sqlite
+imported = timeit.default_timer()
+phases = [('import lazy_orm, sqlite', imported - begin)]
+'''
+
+JOBS = [('eager sa_orm', EAGER),
+        ('lazy_orm', LAZY),
+        ('sqlite job', SQLITE_ONLY)]
+
+
+def run(code):
+    output = subprocess.check_output([
+        sys.executable, '-c',
+        'import json, sys\n' + code +
+        '\nprint json.dumps([phases, "sqlalchemy" in sys.modules])'])
+    return json.loads(output)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Break the startup of an ORM job down into phases.')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for name, code in JOBS:
+        runs = [run(code) for _ in xrange(args.repeat)]
+        print '%s:' % name
+        phases, imported = runs[0]
+        for i, (phase, _) in enumerate(phases):
+            print '  %-24s %8.1f ms' % (
+                phase, median(run[0][i][1] for run in runs) * 1000)
+        print '  %-24s %8s' % ('sqlalchemy imported', imported)
+        print
@@ -0,0 +1,42 @@
+import timeit
+
+
+BATCH_SIZE = 1000
+
+
+def print_record(record):
+    print record
+
+
+def null_sink(record):
+    pass
+
+
+def fetch_batches(execute, batch_size=BATCH_SIZE):
+    # execute is only called on the first iteration, so its time is
+    # counted into the time to the first row.
+    records = execute()
+    while True:
+        batch = records.fetchmany(batch_size)
+        if not batch:
+            return
+        yield batch
+
+
+def stream(batches, sink):
+    start = timeit.default_timer()
+    first_row = None
+    rows = 0
+
+    for batch in batches:
+        if first_row is None:
+            first_row = timeit.default_timer() - start
+        for record in batch:
+            sink(record)
+        rows += len(batch)
+
+    return {
+        'rows': rows,
+        'first_row': first_row,
+        'total': timeit.default_timer() - start
+    }